@@ -0,0 +1,237 @@
+"""
+Load tests a Quork server with a swarm of scripted bots.
+
+Each bot is a real connection using the real wire protocol. It sends a
+command, waits for the next frame from the server, and records the round
+trip, then waits a little and does it again. Latency is measured to the
+first frame after the command, so with a lot of chatter it is a lower bound.
+`say` and `tell` send nothing back, so they count towards throughput only.
+
+    $ python bench_swarm.py --bots 500 --duration 30 --mix wander=5,combat=3,chat=1 --spawn-server
+
+With --spawn-server, the server is started here, and its tick times and
+memory use are reported too.
+"""
+import os, sys, time, random, asyncio, argparse, subprocess
+
+from quork_protocol import encode_frame, FrameBuffer
+
+DIRECTIONS = ("north", "south", "east", "west")
+NO_REPLY = ("say", "tell")  # verbs that send nothing back to the sender
+CHATTER = ("hi", "anyone here?", "gg", "where is everyone", "behind you!")
+
+def wander(bot):
+    while True:
+        yield "go " + random.choice(DIRECTIONS)
+        if random.random() < 0.2:
+            yield "look"
+
+def combat(bot):
+    while True:
+        if random.random() < 0.1 or not bot.names:
+            yield "list"
+            continue
+        yield "aim " + random.choice(bot.names)
+        for _ in range(random.randint(1, 4)):
+            yield "fire"
+        yield "reload"
+        yield "go " + random.choice(DIRECTIONS)
+
+def chat(bot):
+    while True:
+        yield "say " + random.choice(CHATTER)
+        if random.random() < 0.3:
+            yield "info"
+
+behaviours = {"wander": wander, "combat": combat, "chat": chat}
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.commands = 0
+        self.frames = 0
+        self.bytes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.tick_reports = []
+        self.server_rss = []
+
+class Bot:
+    def __init__(self, number, behaviour, stats):
+        self.number = number
+        self.stats = stats
+        self.script = behaviours[behaviour](self)
+        self.names = []
+        self.frames = asyncio.Queue()
+
+    async def run(self, host, port, think, stop_at, timeout):
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.failures += 1
+            return
+        receiver = asyncio.ensure_future(self.receive(reader))
+        try:
+            await self.frames.get()  # the greeting
+            await self.frames.get()  # the MOTD
+            await self.command(writer, "list", timeout)
+            while time.monotonic() < stop_at:
+                await asyncio.sleep(random.expovariate(1 / think) if think else 0)
+                await self.command(writer, next(self.script), timeout)
+        except (OSError, asyncio.IncompleteReadError, EOFError):
+            self.stats.failures += 1
+        finally:
+            receiver.cancel()
+            writer.close()
+
+    async def receive(self, reader):
+        received = FrameBuffer()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                self.frames.put_nowait(None)
+                return
+            self.stats.bytes += len(data)
+            for message in received.feed(data):
+                self.stats.frames += 1
+                self.frames.put_nowait(message)
+
+    async def command(self, writer, command, timeout):
+        while not self.frames.empty():  # don't count anything that arrived earlier
+            if self.frames.get_nowait() is None:
+                raise EOFError
+        start = time.perf_counter()
+        writer.write(encode_frame(command))
+        if command.startswith(NO_REPLY):
+            await writer.drain()
+            self.stats.commands += 1
+            return
+        try:
+            reply = await asyncio.wait_for(self.frames.get(), timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            return
+        if reply is None:
+            raise EOFError
+        self.stats.latencies.append(time.perf_counter() - start)
+        self.stats.commands += 1
+        if reply.startswith("Players:"):
+            self.names = reply.split("\n")[1:]
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in behaviours:
+            raise argparse.ArgumentTypeError("Unknown behaviour '{}'".format(name))
+        weights[name] = float(weight or 1)
+    return weights
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def rss_kb(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+async def watch_server(process, stats):
+    """
+    Drains the spawned server's output, keeping its tick reports,
+    and samples its memory use.
+    """
+    async def sample_memory():
+        while True:
+            rss = rss_kb(process.pid)
+            if rss is not None:
+                stats.server_rss.append(rss)
+            await asyncio.sleep(1)
+    sampler = asyncio.ensure_future(sample_memory())
+    try:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                return
+            if b"tick-report" in line:
+                report = line.decode().split("tick-report", 1)[1]
+                stats.tick_reports.append(dict(part.split("=") for part in report.split()))
+    finally:
+        sampler.cancel()
+
+async def swarm(args):
+    stats = Stats()
+    server = watcher = None
+    if args.spawn_server:
+        server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+        server = await asyncio.create_subprocess_exec(sys.executable, server_path,
+                                                      "--report-interval", "1",
+                                                      *args.server_args,
+                                                      stdout=subprocess.PIPE,
+                                                      stderr=subprocess.STDOUT)
+        watcher = asyncio.ensure_future(watch_server(server, stats))
+        await asyncio.sleep(1)
+
+    names, weights = zip(*args.mix.items())
+    start = time.monotonic()
+    stop_at = start + args.duration
+    bots = []
+    for number in range(args.bots):
+        bot = Bot(number, random.choices(names, weights)[0], stats)
+        bots.append(asyncio.ensure_future(bot.run(args.host, args.port, args.think, stop_at,
+                                                  args.timeout)))
+        if args.ramp:
+            await asyncio.sleep(1 / args.ramp)
+    try:
+        await asyncio.gather(*bots)
+    finally:
+        if server is not None:
+            server.terminate()
+            await server.wait()
+            await watcher
+    report(args, stats, time.monotonic() - start)
+
+def report(args, stats, elapsed):
+    latencies = sorted(stats.latencies)
+    print("{} bots for {:.1f} s ({} failed, {} replies timed out)".format(args.bots, elapsed,
+                                                                         stats.failures,
+                                                                         stats.timeouts))
+    print("commands: {}  ({:.0f}/s)".format(stats.commands, stats.commands / elapsed))
+    print("received: {} frames, {} bytes".format(stats.frames, stats.bytes))
+    print("round trip ms: p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}".format(
+        *(1000 * percentile(latencies, f) for f in (0.5, 0.9, 0.99, 1.0))))
+    if stats.tick_reports:
+        reports = [r for r in stats.tick_reports if int(r["ticks"])]
+        if reports:
+            print("tick ms: mean {:.3f}  max {:.3f}  overruns {}".format(
+                sum(float(r["mean_ms"]) for r in reports) / len(reports),
+                max(float(r["max_ms"]) for r in reports),
+                sum(int(r["overruns"]) for r in reports)))
+    if stats.server_rss:
+        print("server memory: peak {} kB, final {} kB".format(max(stats.server_rss),
+                                                             stats.server_rss[-1]))
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Load test a Quork server with scripted bots.")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=13337)
+    arg_parser.add_argument("--bots", type=int, default=100)
+    arg_parser.add_argument("--duration", type=float, default=10, help="seconds")
+    arg_parser.add_argument("--think", type=float, default=0.5,
+                            help="mean seconds between a bot's commands (default: %(default)s)")
+    arg_parser.add_argument("--timeout", type=float, default=5,
+                            help="seconds to wait for a reply (default: %(default)s)")
+    arg_parser.add_argument("--ramp", type=float, default=200,
+                            help="bots connected per second, 0 for all at once (default: %(default)s)")
+    arg_parser.add_argument("--mix", type=parse_mix, default=parse_mix("wander=5,combat=3,chat=1"),
+                            help="behaviour weights (default: wander=5,combat=3,chat=1)")
+    arg_parser.add_argument("--spawn-server", action="store_true",
+                            help="start server.py here, and report its tick times and memory use")
+    arg_parser.add_argument("server_args", nargs="*",
+                            help="extra arguments for the spawned server, after --")
+    asyncio.run(swarm(arg_parser.parse_args()))
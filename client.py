@@ -1,15 +1,46 @@
-import json, socket, select
+import socket, select
 
-def send_list(connection, list_):
-    bytes_string = bytes(json.dumps(list(list_)), "ascii")
-    if len(bytes_string) > 4096:
-        raise ValueError("List to send too long")
-    while len(bytes_string) < 4096:
-       bytes_string += b" "
-    connection.send(bytes_string)
+# Frames are a varint length followed by UTF-8 text (protocol version 2)
+PROTOCOL_VERSION = 2
+GREETING = "Quork protocol {}".format(PROTOCOL_VERSION)  # the server's first frame
 
-def recieve_list(connection):
-    return json.loads(connection.recv(4096).decode("ascii").strip())
+def encode_frame(message):
+    payload = message.encode("utf-8")
+    length = len(payload)
+    header = bytearray()
+    while length > 0x7f:
+        header.append((length & 0x7f) | 0x80)
+        length >>= 7
+    header.append(length)
+    return bytes(header) + payload
+
+def split_frames(buffer):
+    """
+    Removes every whole frame from the start of `buffer`, and returns their messages.
+    """
+    messages = []
+    position = 0
+    while True:
+        length = shift = 0
+        header_end = position
+        while header_end < len(buffer):
+            byte = buffer[header_end]
+            header_end += 1
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        else:
+            break
+        if header_end + length > len(buffer):
+            break
+        messages.append(buffer[header_end:header_end + length].decode("utf-8"))
+        position = header_end + length
+    del buffer[:position]
+    return messages
+
+def send_message(connection, message):
+    connection.sendall(encode_frame(message))
 
 PORT = 13337  # The same port as used by the server
 connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -25,25 +56,38 @@ except Exception as e:
     print("Session closed!")
 
 connection.setblocking(0)
+received = bytearray()
+greeted = False
 
 while True:
     try:
         readable, writable, exceptional = select.select([connection], [], [], 0.05)
         if readable:
+            data = connection.recv(65536)
+            if not data:
+                print("The server closed the connection.")
+                break
+            received += data
             try:
-                data = recieve_list(connection)
-            except ValueError:
-                continue
-            message = data[0]
-            if message:
-                print(message)
+                messages = split_frames(received)
+            except UnicodeDecodeError:
+                messages = [None]  # not what a version 2 server would send
+            if messages and not greeted:
+                if messages[0] != GREETING:
+                    print("The server doesn't speak protocol version {}.".format(PROTOCOL_VERSION))
+                    break
+                greeted = True
+                messages = messages[1:]
+            for message in messages:
+                if message:
+                    print(message)
     except KeyboardInterrupt:
         try:
             command = input(": ")
             while True:
                 readable, writable, exceptional = select.select([], [connection], [], 0.05)
                 if writable:
-                    send_list(connection, [command])
+                    send_message(connection, command)
                     break
         except KeyboardInterrupt:
             pass
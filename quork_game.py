@@ -0,0 +1,1009 @@
+"""
+The game itself: players, weapons, game types and verbs.
+Nothing here touches the network, so matches can be run and tested
+without a server (see quork_sim.py).
+"""
+import sys, random
+from array import array
+from operator import attrgetter
+
+from verb_parser import Parser, Verb, Variable, Remainder
+import quork_maps
+from quork_protocol import encode_frame
+from quork_metrics import metrics
+from quork_log import logger
+Room = quork_maps.Room
+
+try:
+    import numpy  # optional, for checking every aim in one go
+except ImportError:
+    numpy = None
+
+try:
+    from enum import Enum
+except ImportError:
+    print("""Enum module not found.
+Some incorrect behaviour may occur.
+Try updating to Python 3.4,
+or installing the Enum module - `$ pip install enum34`.
+""", file=sys.stderr)
+    class MetaEnum(type):
+        def __new__(cls, clsname, bases, dct):
+            return super(MetaEnum, cls).__new__(cls, clsname, bases, dct)
+        def __iter__(self):
+            for attr in dir(self):
+                if not attr.startswith("__"):
+                    yield attr
+                    
+    class Enum(metaclass=MetaEnum):
+        pass
+
+def get_direction(direction, room, no_room, unknown_direction):
+    index = Room.direction_index.get(direction)
+    if index is None:
+        return (unknown_direction, None)
+    elif room.links[index] is None:
+        return (no_room, None)
+    else:
+        return (False, room.links[index])
+
+class InjuryCause(Enum):
+    shot = 1
+    game_rule = 2
+
+class InjuryResult(Enum):
+    kill = 1
+    no_kill = 2
+
+class Gun:
+    __slots__ = ("ammo",)
+    max_ammo = None
+    normal_damage = None
+    headshot_damage = None
+    range = 1     # how many moves away it can hit someone
+    loudness = 1  # how many moves away it can be heard
+    success_message = "You shot {name} for {damage} damage!"
+    no_ammo_message = "You don't have any ammo!"
+    
+    def __init__(self, ammo):
+        self.ammo = ammo
+
+    def shoot(self, other, aim_state):
+        """
+        Attempts to shoot an Entity.
+        Returns a message for the shooter.
+        """
+        if self.ammo > 0:
+            self.ammo -= 1
+            if aim_state == AimState.head:
+                damage = self.headshot_damage
+            elif aim_state == AimState.body:
+                damage = self.normal_damage
+            else:
+                return "You aren't aiming at anything the Universe can understand."
+            injury_result = other.injure(damage, InjuryCause.shot)
+            return (injury_result, self.success_message.format(name=other.name,
+                                               damage=damage))
+        else:
+            return (None, self.no_ammo_message)
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.ammo)
+
+class Rifle(Gun):
+    __slots__ = ()
+    max_ammo = 10
+    normal_damage = 20
+    headshot_damage = 40            
+        
+
+class ItemName:
+    __slots__ = ("name", "article", "plural")
+
+    def __init__(self, name, article, plural):
+        self.name = self.name
+        self.article = self.article
+        self.plural = plural
+
+    def string(self, plural=False):
+        if plural:
+            return self.plural
+        else:
+            return self.article + self.name
+
+    def __repr__(self):
+        return "Item({}, {}, {})".format(self.name,
+                                         self.kind,
+                                         self.plural)
+
+class Item:
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+class GameEvent(Enum):
+    kill = 1   # published with the killer and the victim
+    death = 2  # published with the victim and the InjuryCause
+
+class GameEvents:
+    """
+    Passes things that happen in a game on to whatever has subscribed to them,
+    so game types only do work when something relevant changes.
+    """
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, event, callback):
+        self.subscribers.setdefault(event, []).append(callback)
+
+    def publish(self, event, *args):
+        for callback in self.subscribers.get(event, ()):
+            callback(*args)
+
+class SpawnPolicy:
+    """
+    Chooses where entities appear in a Game. This one picks any room.
+    """
+    def choose(self, game):
+        return game.map.random_room(game.random)
+
+class SafeSpawn(SpawnPolicy):
+    """
+    Picks a random room with nobody within `distance` moves of it.
+    Up to `tries` rooms are tried, and if none of them are safe, the one
+    with the fewest occupied rooms nearby is used.
+    Each try only looks at the rooms near it, so it doesn't matter how
+    many players or rooms there are.
+    """
+    def __init__(self, distance=1, tries=8):
+        self.distance = distance
+        self.tries = tries
+
+    def choose(self, game):
+        best = None
+        best_count = None
+        for _ in range(self.tries):
+            room = game.map.random_room(game.random)
+            count = sum(1 for hops, nearby in game.map.nearby(room, self.distance)
+                        if nearby.id in game.occupants or nearby.id in game.grue_occupants)
+            if not count:
+                return room
+            if best is None or count < best_count:
+                best, best_count = room, count
+        return best
+
+class GameType:
+    name = "Base game type"
+    rules = "This isn't a real game type"
+    spawn_policy = SpawnPolicy()
+
+    @classmethod
+    def start(cls, game):
+        """
+        Called when a Game of this type is created, to subscribe to `game.events`
+        """
+        pass
+
+    @classmethod
+    def tick(cls, game):
+        """
+        `game.game_type.tick(game)` is run every tick
+        """
+        pass
+
+class BaseDeathmatch(GameType):
+    name = "Base deathmatch game type"
+    rules = "Kill to gain points."
+    spawn_policy = SafeSpawn()
+
+    max_kills = 0
+
+    @classmethod
+    def start(cls, game):
+        game.events.subscribe(GameEvent.kill, cls.on_kill)
+
+    @classmethod
+    def on_kill(cls, killer, victim):
+        """
+        If the killer has enough kills, declare them the winner and start a new round.
+        In a simultaneous game, others can get there in the same tick, and share the win.
+        """
+        if killer.can_win and killer.kills >= cls.max_kills:
+            players = killer.game.players.values()
+            winners = [p for p in players if p.can_win and p.kills >= cls.max_kills]
+            for p in winners:
+                p.log("Congratulations, you win!")
+            if len(winners) == 1:
+                message = "{} is the winner!".format(killer.name)
+            else:
+                message = "{} are the winners!".format(" and ".join(p.name for p in winners))
+            Player.message_players([p for p in players if p not in winners], message)
+            for p in players:
+                p.kills = 0
+                p.deaths = 0
+                p.respawn()
+
+class Deathmatch25(BaseDeathmatch):
+    name = "Deathmatch"
+    rules = "First to 25 kills."
+    max_kills = 25
+
+class Game:
+    """
+    A single match, which owns its players, their clients and the state of its rooms.
+    Any number of Games can share a Map, and be run by the same loop.
+
+    Everything random in a Game comes from `game.random`, so a Game made with
+    the same `seed` and sent the same commands at the same ticks plays out
+    the same way.
+
+    If `simultaneous` is set, actions (see `phases`) aren't carried out when
+    they are typed, but queued and resolved together at the next tick, so
+    the order commands arrive in within a tick doesn't matter.
+    """
+    # The order queued actions are resolved in
+    phases = {"go": 0, "aim": 1, "aim_head": 1, "aim_at": 1, "reload": 2, "fire": 3}
+    FIRE_PHASE = 3
+
+    def __init__(self, game_map, game_type, simultaneous=False, seed=None):
+        self.map = game_map
+        self.game_type = game_type
+        self.events = GameEvents()
+        self.players = {}
+        self.grues = {}
+        self.clients = []
+        self.messaged = set()  # players with messages waiting in `data`, for the server
+        self.player_number = 0
+        self.occupants = {}  # room id -> set of entities, for the rooms that have any
+        self.grue_occupants = {}  # the same for grues, who don't need to hear anything
+        self.flow_field = None  # (player rooms, distance, steps) from the grues' last turn
+        self.entities = EntityStore()
+        self.ticks = 0
+        self.simultaneous = simultaneous
+        self.actions = []  # (phase, slot, order, handler, variables), waiting for the tick
+        # While shots are being resolved together, deaths (victim, cause) and then
+        # kills (killer, victim) wait here until every shot has landed
+        self.pending_deaths = None
+        self.pending_kills = None
+        self.seed = random.randrange(1 << 32) if seed is None else seed
+        self.random = random.Random(self.seed)
+        self.journal = None  # a Journal recording what the players do, set by the server
+        game_type.start(self)
+
+    def occupants_of(self, room):
+        return self.occupants.get(room.id, ())
+
+    def new_player_name(self):
+        while str(self.player_number).zfill(3) in self.players:
+            self.player_number += 1
+        return str(self.player_number).zfill(3)
+
+    def find(self, name):
+        """
+        Returns the player or grue called `name`, or None
+        """
+        return self.players.get(name) or self.grues.get(name)
+
+    def remove_player(self, player):
+        if self.journal is not None:
+            self.journal.leave(player)
+        del self.players[player.name]
+        self.messaged.discard(player)
+        player.remove()
+
+    def spawn_room(self):
+        """
+        Where something new, or respawning, should appear
+        """
+        return self.game_type.spawn_policy.choose(self)
+
+    def spawn_grues(self, count):
+        for _ in range(count):
+            Grue(self, grue_name(self), self.spawn_room())
+
+    def act(self, entity, handler, variables):
+        """
+        Carries out an action now, or queues it for the next tick
+        if the game is simultaneous
+        """
+        if self.simultaneous and handler in self.phases:
+            self.actions.append((self.phases[handler], entity.slot, len(self.actions),
+                                 handler, variables))
+        else:
+            getattr(entity, handler)(**variables)
+
+    def resolve_actions(self):
+        """
+        Carries out the queued actions: everyone moves, then aims are
+        checked, then everyone fires. Within a phase actions go in slot
+        order, and deaths wait until every shot has landed, so two players
+        who shoot each other in the same tick can both die. Kills are
+        announced after every death, so a round won by one of them doesn't
+        restart halfway through.
+        """
+        actions = sorted(self.actions)  # order is unique, so variables are never compared
+        self.actions = []
+        entities = self.entities.entities
+        for phase, slot, order, handler, variables in actions:
+            entity = entities[slot]
+            if entity is None:  # it left the game since
+                continue
+            if phase == self.FIRE_PHASE and self.pending_deaths is None:
+                self.check_aims()  # against where everyone has moved to
+                self.pending_deaths = []
+                self.pending_kills = []
+            getattr(entity, handler)(**variables)
+        if self.pending_deaths is not None:
+            deaths, self.pending_deaths = self.pending_deaths, None
+            kills, self.pending_kills = self.pending_kills, None
+            for victim, cause in deaths:
+                victim.die(cause)
+            for killer, victim in kills:
+                self.events.publish(GameEvent.kill, killer, victim)
+
+    def check_aims(self):
+        # Only entities that are aiming have anything to check
+        entities = self.entities.entities
+        for slot, aim in self.entities.invalid_aims(self.map):
+            entities[slot].lose_target(aim)
+
+    def tick(self):
+        self.game_type.tick(self)
+        if self.simultaneous:
+            if self.grues:
+                run_grues(self)  # their actions are queued with everyone else's
+            if self.actions:
+                self.resolve_actions()
+        self.check_aims()
+        if self.grues and not self.simultaneous:
+            run_grues(self)
+        self.entities.recycle()
+        self.ticks += 1
+        if self.journal is not None:
+            self.journal.tick(self)
+
+    def __repr__(self):
+        return "Game({}, {})".format(str(self.map), repr(self.game_type))
+
+def column_property(column):
+    """
+    An attribute of an Entity kept in `column` of its Game's EntityStore
+    """
+    get_column = attrgetter(column)
+    def get(self):
+        return get_column(self.store)[self.slot]
+    def set(self, value):
+        get_column(self.store)[self.slot] = value
+    return property(get, set)
+
+class Entity:
+    """
+    Something in a Game's rooms. Most of its state is kept in the Game's
+    EntityStore, at `self.slot`, and the attributes here read and write it.
+    """
+    __slots__ = ("game", "store", "name", "slot")
+    max_health = None
+    listens = True  # kept in `game.occupants`, so it hears what happens nearby
+    
+    def __init__(self, game, name, room):
+        self.game = game
+        self.store = game.entities
+        self.name = name
+        self.slot = self.store.add(self)
+        self.room = room
+        self.reset()
+
+    health = column_property("health")
+
+    @property
+    def room(self):
+        room_id = self.store.room[self.slot]
+        return self.game.map.room_list[room_id] if room_id >= 0 else None
+
+    @room.setter
+    def room(self, room):
+        occupants = self.game.occupants if self.listens else self.game.grue_occupants
+        room_ids = self.store.room
+        old_id = room_ids[self.slot]
+        if old_id >= 0:
+            others = occupants[old_id]
+            others.discard(self)
+            if not others:
+                del occupants[old_id]
+        if room is not None:
+            room_ids[self.slot] = room.id
+            occupants.setdefault(room.id, set()).add(self)
+        else:
+            room_ids[self.slot] = -1
+
+    def reset(self):
+        self.health = self.max_health
+
+    def remove(self):
+        """
+        Takes the Entity out of the game, and frees its slot
+        """
+        self.room = None
+        self.store.remove(self.slot)
+
+    def __repr__(self):
+        return "{}({}, {})".format(type(self).__name__,
+                                   repr(self.name),
+                                   repr(self.room))
+
+
+class AimState(Enum):
+    none = 1
+    body = 2
+    head = 3
+
+aim_states = {s.value: s for s in AimState}
+AIM_NONE, AIM_BODY, AIM_HEAD = AimState.none.value, AimState.body.value, AimState.head.value
+
+class EntityStore:
+    """
+    The state of every Entity in a Game, in arrays indexed by `entity.slot`,
+    so that scanning it each tick doesn't touch every object.
+    Rooms and targets are stored as ids, with -1 for none, and `reach` is
+    the range of the entity's gun.
+    """
+    columns = {"health": ("i", 0), "ammo": ("i", 0), "room": ("i", -1),
+               "aim": ("b", AIM_NONE), "target": ("i", -1), "target_room": ("i", -1),
+               "reach": ("B", 1)}
+
+    def __init__(self):
+        self.entities = []  # slot -> Entity, or None if the slot is free
+        self.free = []
+        self.released = []  # slots freed this tick, reused after the next one
+        for column, (typecode, default) in self.columns.items():
+            setattr(self, column, array(typecode))
+
+    def add(self, entity):
+        if self.free:
+            slot = self.free.pop()
+            self.entities[slot] = entity
+        else:
+            slot = len(self.entities)
+            self.entities.append(entity)
+            for column, (typecode, default) in self.columns.items():
+                getattr(self, column).append(default)
+        return slot
+
+    def remove(self, slot):
+        self.entities[slot] = None
+        for column, (typecode, default) in self.columns.items():
+            getattr(self, column)[slot] = default
+        # Entities aiming at this one notice it has gone at the next tick,
+        # so the slot can't be given to anything else until then
+        self.released.append(slot)
+
+    use_numpy = numpy is not None
+    numpy_threshold = 50  # below this many slots, plain Python is quicker
+
+    def aim_valid(self, slot, game_map):
+        """
+        Whether the entity in `slot` can still hit what it is aiming at.
+        A body shot needs the target within range of the entity's gun,
+        and a headshot needs it in the room it was in when aimed at.
+        """
+        aim = self.aim[slot]
+        target_room = self.room[self.target[slot]]  # -1 if the target has left the game
+        if aim == AIM_HEAD:
+            return target_room == self.target_room[slot]
+        elif aim == AIM_BODY:
+            if target_room < 0:
+                return False
+            if game_map.distances is None:  # too big a map for a distance table
+                reach = self.reach[slot]
+                return game_map.distance(self.room[slot], target_room, reach) <= reach
+            room_count = len(game_map.room_list)
+            return game_map.distances[self.room[slot] * room_count + target_room] <= self.reach[slot]
+        return True
+
+    def invalid_aims(self, game_map):
+        """
+        Returns (slot, aim) for each entity whose aim is no longer valid
+        """
+        if not self.entities:
+            return []
+        if (self.use_numpy and len(self.entities) >= self.numpy_threshold and
+                game_map.distances is not None):
+            return self._invalid_aims_numpy(game_map)
+        aim_valid = self.aim_valid
+        return [(slot, aim) for slot, aim in enumerate(self.aim)
+                if aim != AIM_NONE and not aim_valid(slot, game_map)]
+
+    def _invalid_aims_numpy(self, game_map):
+        # Views of the arrays, not copies. They must not outlive this call,
+        # as an array can't grow while it is viewed.
+        aim = numpy.frombuffer(self.aim, numpy.byte)
+        aiming = numpy.flatnonzero(aim != AIM_NONE)
+        if not aiming.size:
+            return []
+        rooms = numpy.frombuffer(self.room, numpy.intc)
+        own_rooms = rooms[aiming]
+        target_rooms = rooms[numpy.frombuffer(self.target, numpy.intc)[aiming]]
+        room_count = len(game_map.room_list)
+        distances = numpy.frombuffer(game_map.distances, numpy.uint8).reshape(room_count, room_count)
+
+        # A target_room of -1 picks the last column, but is ruled out anyway
+        in_range = (target_rooms >= 0) & (distances[own_rooms, target_rooms] <=
+                                          numpy.frombuffer(self.reach, numpy.uint8)[aiming])
+        unmoved = target_rooms == numpy.frombuffer(self.target_room, numpy.intc)[aiming]
+        aims = aim[aiming]
+        invalid = ~numpy.where(aims == AIM_HEAD, unmoved, in_range)
+        return list(zip(aiming[invalid].tolist(), aims[invalid].tolist()))
+
+    def recycle(self):
+        self.free.extend(self.released)
+        self.released = []
+
+    def __len__(self):
+        return len(self.entities) - len(self.free) - len(self.released)
+
+
+class Player(Entity):
+    __slots__ = ("kills", "deaths", "data", "_gun", "admin")
+    max_health = 100
+    start_ammo = 10
+    can_win = True
+
+    def __init__(self, game, name, room):
+        self.admin = False  # allowed to use admin verbs, set by the server
+        super().__init__(game, name, room)
+        self.kills = 0
+        self.deaths = 0
+        self.data = []  # messages, and frames already encoded by `message_players`
+        self.reset()
+        self.join(game)
+
+    def join(self, game):
+        game.players[self.name] = self
+        if game.journal is not None:
+            game.journal.join(self)
+
+    ammo = column_property("ammo")
+
+    @property
+    def gun(self):
+        return self._gun
+
+    @gun.setter
+    def gun(self, gun):
+        self._gun = gun
+        self.store.reach[self.slot] = gun.range
+
+    @property
+    def aim_state(self):
+        return aim_states[self.store.aim[self.slot]]
+
+    @aim_state.setter
+    def aim_state(self, aim_state):
+        self.store.aim[self.slot] = aim_state.value
+
+    @property
+    def target(self):
+        slot = self.store.target[self.slot]
+        return self.store.entities[slot] if slot >= 0 else None
+
+    @target.setter
+    def target(self, target):
+        self.store.target[self.slot] = target.slot if target is not None else -1
+
+    @property
+    def target_room(self):
+        room_id = self.store.target_room[self.slot]
+        return self.game.map.room_list[room_id] if room_id >= 0 else None
+
+    @target_room.setter
+    def target_room(self, room):
+        self.store.target_room[self.slot] = room.id if room is not None else -1
+
+    @staticmethod
+    def message_players(players, message, source=None):
+        """
+        Sends the same message to several players.
+        It is encoded once, and every player queues the same frame.
+        """
+        frame = encode_frame(message)
+        for p in players:
+            if p != source:
+                p.data.append(frame)
+                p.game.messaged.add(p)
+        logger.debug("to everyone: {}", message)
+
+    def log(self, message):
+        """
+        Logs a message to be sent to the Client the Player belongs to
+        """
+        self.data.append(message)
+        self.game.messaged.add(self)
+        logger.debug("to {}: {}", self.name, message)
+
+    def do(self, command):
+        """
+        Carries out a command typed by the player.
+        Returns the Verb, or None if the command wasn't understood.
+        """
+        result = parser.parse(command)
+        if result is not None:
+            verb, variables = result
+            if self.game.journal is not None:
+                self.game.journal.command(self, verb, variables)
+            self.game.act(self, verb.handler, variables)
+            # e.g. if verb is `Verbs.aim_head.value`, then this calls `self.aim_head(name=variables["name"])`
+            return verb
+        else:
+            similar = [v.value for v in Verbs if command.startswith(v.value.words[0])]
+            if similar:
+                for s in similar:
+                    self.log("Did you mean '{}'?".format(str(s)))
+            self.log("Unknown command '{}'".format(command))
+
+    def reset(self):
+        self.gun = Rifle(Rifle.max_ammo)
+        self.ammo = self.start_ammo
+        self.aim_state = AimState.none
+        self.target = None
+        self.target_room = None
+        super().reset()
+        
+
+    def in_rooms(self, rooms):
+        return self.room in rooms
+
+    def respawn(self):
+        self.room = None  # so it doesn't count as someone near where it appears
+        self.room = self.game.spawn_room()
+        self.reset()
+
+    def die(self, cause):
+        self.log("You were killed!")
+        self.deaths += 1
+        self.respawn()
+        self.game.events.publish(GameEvent.death, self, cause)
+    
+    def injure(self, damage, cause):
+        self.health -= damage
+        self.log("You were shot for {} damage!".format(damage))
+        if self.health <= 0:
+            if self.game.pending_deaths is not None:  # dies once every shot this tick has landed
+                if self.health + damage <= 0:
+                    return InjuryResult.no_kill  # someone else already killed it
+                self.game.pending_deaths.append((self, cause))
+                return InjuryResult.kill
+            self.die(cause)
+            return InjuryResult.kill
+        else:
+            return InjuryResult.no_kill
+
+    def aim_at(self, target, aim_state):
+        self.aim_state = aim_state
+        self.target = target
+        if aim_state == AimState.head:
+            self.target_room = target.room
+        else:
+            self.target_room = None
+
+    def aim_base(self, name, success_message, aim_state):
+        unknown_person = "There is nothing called {name}!"
+        out_of_range = "{name} is out of range!"
+        target = self.game.find(name)
+        if target is None:
+            self.log(unknown_person.format(name=name))
+        elif self.game.map.distance(self.room, target.room, self.gun.range) <= self.gun.range:
+            self.aim_at(target, aim_state)
+            self.log(success_message.format(name=name))
+        else:
+            self.log(out_of_range.format(name=name))
+
+    def look_base(self, room):
+        self.log(room.name.capitalize())
+        self.log(room.description)        
+
+    def update(self):
+        """
+        Checks the Player's aim on its own. Game.tick checks everyone's at once.
+        """
+        aim = self.store.aim[self.slot]
+        if aim != AIM_NONE and not self.store.aim_valid(self.slot, self.game.map):
+            self.lose_target(aim)
+
+    lost_target_messages = {AIM_HEAD: "Your target has run out of your sights!",
+                            AIM_BODY: "Your target has run away!"}
+
+    def lose_target(self, aim):
+        self.aim_at(None, AimState.none)
+        self.log(self.lost_target_messages[aim])
+
+            
+    # The following methods correspond directly to commands.
+    # They all return a message for the Player who calls them
+
+    def aim(self, name):
+        self.aim_base(name, "You point your gun at {name}!", AimState.body)
+
+    def aim_head(self, name):
+        self.aim_base(name, "You point your gun at {name}'s head!", AimState.head)
+
+    def fire(self):
+        if self.aim_state != AimState.none and self.target is None:
+            self.update()  # the target has left the game since the last tick
+        if self.aim_state != AimState.none:
+            # self.update() guarantees a valid, in range target
+            old_target = self.target
+            room = self.room  # shooting yourself dead moves you
+            result, message = self.gun.shoot(self.target, self.aim_state)
+            self.log(message)
+            if result is not None:  # shooting was successful
+                occupants_of = self.game.occupants_of
+                for hops, nearby in self.game.map.nearby(room, self.gun.loudness):
+                    if hops == 0:
+                        for p in occupants_of(room):
+                            if p != self:
+                                p.log("You hear a loud bang in the room you are in!")
+                        continue
+                    elif hops == 1:
+                        d = next(d for d, r in nearby.exits if r is room)
+                        message = "You hear a loud bang to the {}!".format(d)
+                    else:
+                        message = "You hear a distant bang!"
+                    for p in occupants_of(nearby):
+                        p.log(message)
+                
+            if result == InjuryResult.kill:
+                if old_target == self:
+                    self.log("You killed yourself!")
+                else:
+                    self.log("You killed {}!".format(self.target.name))
+                    self.target = None
+                    self.aim_state = AimState.none
+                    self.target_room = None
+                    self.kills += 1
+                    if self.game.pending_kills is not None:
+                        self.game.pending_kills.append((self, old_target))
+                    else:
+                        self.game.events.publish(GameEvent.kill, self, old_target)
+        else:
+            self.log("You aren't aiming at anything!")
+
+    def reload(self):
+        spaces = self.gun.max_ammo - self.gun.ammo
+        if self.ammo == 0:
+            self.log("You have no ammo left in your pockets!")
+        if self.ammo <= spaces:
+            self.gun.ammo += self.ammo
+            self.ammo = 0
+        else:
+            self.gun.ammo = self.gun.max_ammo
+            self.ammo -= spaces
+        self.log("You reloaded {bullets} bullets!".format(bullets=spaces))
+
+    def go(self, direction):
+        message, destination = get_direction(direction, self.room,
+                                             "You can't go that way!",
+                                             "'{}' isn't a direction...".format(direction))
+        if destination:
+            for p in self.game.occupants_of(self.room):
+                if p != self:
+                    p.log("You hear footsteps leaving the room!")
+            self.room = destination
+            self.log("You went {}!".format(direction))
+            for p in self.game.occupants_of(self.room):
+                if p != self:
+                    p.log("You hear footsteps entering the room!")
+        else:
+            self.log(message)
+
+    def look(self):
+        self.look_base(self.room)
+        for d, room in self.room.exits:
+            self.log("To the {direction} is {room}.".format(direction=d, room=room.name))
+                
+    def look_direction(self, direction):
+        message, room = get_direction(direction, self.room,
+                                      "There's nothing in that direction!",
+                                      "'{}' isn't a direction".format(direction))
+        if room:
+            self.look_base(room)
+        else:
+            self.log(message)
+
+    def info(self):
+        self.log("You have {} health".format(self.health))
+        self.log("{} ammo in your gun".format(self.gun.ammo))
+        self.log("{} ammo in your pocket".format(self.ammo))
+
+    def stats(self):
+        self.log("{} kills".format(self.kills))
+        self.log("{} deaths".format(self.deaths))
+
+    def say(self, message):
+        Player.message_players(self.game.players.values(),
+                               '{} said "{}"'.format(self.name, message),
+                               source=self)
+
+    def tell(self, name, message):
+        try:
+            self.game.players[name].log('{} told you "{}"'.format(self.name,
+                                                              message))
+        except KeyError:
+            self.log("Unknown person '{}'".format(name))
+
+    def set_name_to(self, name):
+        if any(c in name for c in "`¬¦!\"£$%^&*()-_=+[{]};:'@#~,<.>/?\\|\n\t "):
+            self.log("Names may not contain punctuation or whitespace!")
+        elif self.game.find(name[:3].lower().zfill(3)) is not None:
+            self.log("Someone already has that name!")
+        else:
+            old_name = self.name
+            new_name = name[:3].lower().zfill(3)
+            self.game.players[new_name] = self
+            del self.game.players[old_name]
+            self.name = new_name
+            self.log("Name changed to '{}'!".format(self.name))
+
+    def list_players(self):
+        self.log("Players:")
+        for name in self.game.players:
+            self.log(name)
+        if self.game.grues:
+            self.log("Grues:")
+            for name in self.game.grues:
+                self.log(name)
+
+    def display_map(self):
+        self.log(self.game.map.display)
+
+    def rules(self):
+        self.log(self.game.game_type.rules)
+
+    def get_help(self):
+        self.log(help_text)
+
+    def server_stats(self):
+        if not self.admin:
+            self.log("Only players on the server's own machine can do that!")
+            return
+        self.log("\n".join(metrics.report()))               
+                
+
+class Verbs(Enum):
+    aim = Verb("aim", Variable("name"), desc="aim at someone's body")
+    aim_head = Verb("aim", Variable("name"), "head", desc="aim at someone's head")
+    fire = Verb("fire", desc="fire at whoever you are aiming at")
+    fire.alias("shoot")
+    reload = Verb("reload", desc="reload your gun")
+    go = Verb("go", Variable("direction"), desc="move to an adjacent room")
+    look = Verb("look", desc="look at the room you are in")
+    look_direction = Verb("look", Variable("direction"), desc="look into an adjacent room")
+    info = Verb("info", desc="get info on your health and inventory")
+    stats = Verb("stats", desc="get your kill and death stats")
+    say = Verb("say", Remainder("message"), desc="say something to everyone on the server")
+    tell = Verb("tell", Variable("name"), Remainder("message"), desc="tell an individual something")
+    set_name_to = Verb("set", "name", "to", Variable("name"), desc="change your name")
+    list_players = Verb("list", desc="list all online players")
+    display_map = Verb("map", desc="display the map")
+    get_help = Verb("help", desc="display this")
+    rules = Verb("rules", desc="display the rules of the current game")
+    server_stats = Verb("server", "stats", desc="display the server's metrics (admins only)")
+
+    @staticmethod
+    def verb_name(verb):
+        if verb.handler is None:
+            raise ValueError("Unknown verb {}".format(repr(verb)))
+        return verb.handler
+
+    @classmethod
+    def generate_help(cls):
+        return "\n".join(map(lambda v: str(v.value), cls))
+
+for v in Verbs:
+    v.value.handler = v.name
+
+help_text = Verbs.generate_help()
+
+help_text += """
+You can only shoot at someone normally in the room you are in, or an adjacent one.
+However, you can only shoot someone you are aiming at the head at if they are in the same room they were in when you aimed at them.
+Normal shots do 20 damage, and headshots do 40 damage.
+"""
+    
+parser = Parser(list(map(attrgetter("value"), Verbs)))
+
+def grue_name(game):
+    """
+    Returns an unused grue name, which gets longer once short ones are hard to find
+    """
+    letters = "rhgmnsz"
+    length = 3
+    while True:
+        for _ in range(10):
+            name = "".join(game.random.choice(letters) for _ in range(length))
+            if game.find(name) is None:
+                return name
+        length += 1
+
+class Grue(Player):
+    """
+    A computer controlled enemy, which fights by the same rules as players.
+    Grues don't decide what to do themselves, `run_grues` decides for all
+    of them at once.
+    """
+    __slots__ = ()
+    max_health = 60
+    can_win = False
+    listens = False
+    think_interval = 10  # ticks between each grue's actions
+
+    def join(self, game):
+        game.grues[self.name] = self
+
+    def log(self, message):
+        pass  # nobody is listening
+
+    def remove(self):
+        del self.game.grues[self.name]
+        super().remove()
+
+# What a grue can do on its turn
+GRUE_WAIT, GRUE_MOVE, GRUE_AIM, GRUE_FIRE = range(4)
+
+def grue_actions(store, slots, distance):
+    """
+    Decides what each of the grues in `slots` does, from the distance of
+    each room to the nearest player. Returns a list of GRUE_ actions.
+    """
+    if store.use_numpy and len(slots) >= store.numpy_threshold:
+        slots = numpy.array(slots, numpy.intc)
+        rooms = numpy.frombuffer(store.room, numpy.intc)[slots]
+        distances = numpy.frombuffer(distance, numpy.intc)[rooms]
+        aiming = numpy.frombuffer(store.aim, numpy.byte)[slots] != AIM_NONE
+        in_range = distances <= numpy.frombuffer(store.reach, numpy.uint8)[slots]
+        return numpy.select([in_range, distances < len(distance)],
+                            [numpy.where(aiming, GRUE_FIRE, GRUE_AIM), GRUE_MOVE],
+                            GRUE_WAIT).tolist()
+    rooms = store.room
+    aims = store.aim
+    reach = store.reach
+    actions = []
+    for slot in slots:
+        hops = distance[rooms[slot]]
+        if hops <= reach[slot]:
+            actions.append(GRUE_AIM if aims[slot] == AIM_NONE else GRUE_FIRE)
+        else:
+            actions.append(GRUE_MOVE if hops < len(distance) else GRUE_WAIT)
+    return actions
+
+def run_grues(game):
+    """
+    The grues' turn. A flow field from every room with a player in it is
+    worked out once, and kept until a player moves, so finding the way for
+    any number of grues is a lookup.
+    Each grue acts every `Grue.think_interval` ticks, staggered so that the
+    same number act each tick.
+    """
+    grues = list(game.grues.values())[game.ticks % Grue.think_interval::Grue.think_interval]
+    if not grues:
+        return
+    store = game.entities
+    player_rooms = {store.room[p.slot] for p in game.players.values()}
+    player_rooms.discard(-1)
+    if game.flow_field is None or game.flow_field[0] != player_rooms:
+        game.flow_field = (player_rooms,) + game.map.flow_field(player_rooms)
+    player_rooms, distance, steps = game.flow_field
+    actions = grue_actions(store, [g.slot for g in grues], distance)
+    for grue, action in zip(grues, actions):
+        if action == GRUE_MOVE:
+            game.act(grue, "go", {"direction": Room.directions[steps[store.room[grue.slot]]]})
+        elif action == GRUE_AIM:
+            for hops, nearby in game.map.nearby(grue.room, grue.gun.range):
+                players = game.occupants_of(nearby)
+                if players:
+                    # sorted, as sets of entities are in a different order every run
+                    target = game.random.choice(sorted(players, key=attrgetter("slot")))
+                    game.act(grue, "aim_at", {"target": target, "aim_state": AimState.body})
+                    break
+        elif action == GRUE_FIRE:
+            game.act(grue, "fire" if grue.gun.ammo else "reload", {})
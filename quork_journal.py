@@ -0,0 +1,208 @@
+"""
+A binary journal of everything players do, for replaying matches.
+
+    journal = Journal("matches.journal")
+    journal.start(game)
+
+records the game's seed and map and then every player joining, leaving and sending
+a command it understood, along with the tick it happened on. As a Game is
+deterministic given its seed, that is enough for `quork_replay.py` to play
+the match out again. A checksum of the match is recorded every
+`check_interval` ticks and when it ends, so a replay that goes differently
+is caught at about the tick it went wrong.
+
+Recording only packs a few bytes into a queue. A background thread writes
+the queue to the file in batches, so the game never waits for the disk.
+"""
+import time, struct, atexit, threading, zlib
+from collections import deque
+
+from quork_game import Verbs
+from quork_log import logger
+
+MAGIC = b"QJNL"
+VERSION = 2
+
+# Kinds of record
+START, JOIN, COMMAND, LEAVE, END, CHECK = range(6)
+
+header = struct.Struct("<BIII")  # kind, tick, match, slot of the player
+start_fields = struct.Struct("<QIB16s")  # seed, grues, simultaneous, digest of the map
+join_fields = struct.Struct("<I")  # room id
+command_fields = struct.Struct("<BB")  # verb, number of arguments
+end_fields = struct.Struct("<I")  # outcome, for CHECK too
+text_length = struct.Struct("<I")
+
+verbs = [v.value for v in Verbs]
+verb_ids = {verb: number for number, verb in enumerate(verbs)}
+# The names of each verb's variables, in the order they are written
+variable_names = [[word.name for word in verb.words if not isinstance(word, str)]
+                  for verb in verbs]
+
+class JournalError(ValueError):
+    pass
+
+def encode_text(text):
+    data = text.encode("utf-8")
+    return text_length.pack(len(data)) + data
+
+def decode_text(data, offset):
+    (length,) = text_length.unpack_from(data, offset)
+    offset += text_length.size
+    if offset + length > len(data):
+        raise struct.error("text runs past the end")
+    return data[offset:offset + length].decode("utf-8"), offset + length
+
+def outcome(game):
+    """
+    A checksum of the scores, health and position of everyone in `game`,
+    to tell whether a replay ended up in the same place
+    """
+    state = [(e.name, e.kills, e.deaths, e.health, e.ammo, e.room.id)
+             for e in list(game.players.values()) + list(game.grues.values())]
+    return zlib.crc32(repr(state).encode("utf-8"))
+
+class Journal:
+    check_interval = 100  # ticks
+
+    def __init__(self, path, interval=0.1):
+        self.path = path
+        self.file = open(path, "ab")  # a restarted server carries on after the last session
+        self.queue = deque()  # encoded records, appended by the game and written by the writer
+        self.games = {}  # Game -> match number, for the matches still running
+        self.matches = 0
+        self.lock = threading.Lock()  # so batches are written in order
+        self.interval = interval
+        self.closed = False
+        self.queue.append(MAGIC + bytes([VERSION]))
+        self.writer = threading.Thread(target=self.write_forever, name="quork-journal", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def start(self, game):
+        """
+        Starts recording `game`, which should have had its grues spawned already
+        """
+        self.games[game] = self.matches
+        self.matches += 1
+        game.journal = self
+        self.queue.append(header.pack(START, game.ticks, self.games[game], 0)
+                          + start_fields.pack(game.seed, len(game.grues), game.simultaneous,
+                                              game.map.digest())
+                          + encode_text(game.map.name)
+                          + encode_text(game.game_type.__name__))
+
+    def join(self, player):
+        game = player.game
+        self.queue.append(header.pack(JOIN, game.ticks, self.games[game], player.slot)
+                          + join_fields.pack(player.room.id)
+                          + encode_text(player.name))
+
+    def command(self, player, verb, variables):
+        game = player.game
+        number = verb_ids[verb]
+        names = variable_names[number]
+        self.queue.append(header.pack(COMMAND, game.ticks, self.games[game], player.slot)
+                          + command_fields.pack(number, len(names))
+                          + b"".join(encode_text(variables[name]) for name in names))
+
+    def leave(self, player):
+        game = player.game
+        self.queue.append(header.pack(LEAVE, game.ticks, self.games[game], player.slot))
+
+    def tick(self, game):
+        if not game.ticks % self.check_interval:
+            self.queue.append(header.pack(CHECK, game.ticks, self.games[game], 0)
+                              + end_fields.pack(outcome(game)))
+
+    def end(self, game):
+        """
+        Stops recording `game`, noting how it ended up
+        """
+        self.queue.append(header.pack(END, game.ticks, self.games.pop(game), 0)
+                          + end_fields.pack(outcome(game)))
+        game.journal = None
+
+    def write_forever(self):
+        while not self.closed:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = []
+            while self.queue:
+                batch.append(self.queue.popleft())
+            if batch and not self.file.closed:
+                try:
+                    self.file.write(b"".join(batch))
+                    self.file.flush()
+                except OSError as e:
+                    logger.error("Couldn't write to the journal {}: {}", self.path, e)
+
+    def close(self):
+        """
+        Ends every match still being recorded, and writes out the rest
+        """
+        if self.closed:
+            return
+        for game in list(self.games):
+            self.end(game)
+        self.closed = True
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+def read_journal(path):
+    """
+    Yields `(session, kind, tick, match, slot, fields)` for each record in a
+    journal. `session` counts the times a server opened it, as each one
+    numbers its matches from 0. A record cut short by a crash ends it.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith(MAGIC):
+        raise JournalError("{} isn't a journal".format(path))
+    session = -1
+    offset = 0
+    while offset < len(data):
+        try:
+            if data.startswith(MAGIC, offset):
+                version = data[offset + len(MAGIC)]
+                if version != VERSION:
+                    raise JournalError("{} is a version {} journal, not version {}".format(
+                        path, version, VERSION))
+                session += 1
+                offset += len(MAGIC) + 1
+                continue
+            kind, tick, match, slot = header.unpack_from(data, offset)
+            offset += header.size
+            if kind == START:
+                seed, grues, simultaneous, map_digest = start_fields.unpack_from(data, offset)
+                offset += start_fields.size
+                map_name, offset = decode_text(data, offset)
+                game_type, offset = decode_text(data, offset)
+                fields = (seed, grues, bool(simultaneous), map_name, map_digest, game_type)
+            elif kind == JOIN:
+                (room,) = join_fields.unpack_from(data, offset)
+                offset += join_fields.size
+                name, offset = decode_text(data, offset)
+                fields = (room, name)
+            elif kind == COMMAND:
+                verb, count = command_fields.unpack_from(data, offset)
+                offset += command_fields.size
+                arguments = []
+                for _ in range(count):
+                    argument, offset = decode_text(data, offset)
+                    arguments.append(argument)
+                fields = (verb, arguments)
+            elif kind == LEAVE:
+                fields = ()
+            elif kind == END or kind == CHECK:
+                fields = end_fields.unpack_from(data, offset)
+                offset += end_fields.size
+            else:
+                raise JournalError("Unknown record kind {} at byte {} of {}".format(kind, offset, path))
+        except (struct.error, IndexError, UnicodeDecodeError):
+            return  # cut short
+        yield (session, kind, tick, match, slot, fields)
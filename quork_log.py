@@ -0,0 +1,103 @@
+"""
+Logging that never holds up the game loop.
+
+Messages below `logger.level` are dropped straight away. The rest go into
+a fixed size ring buffer, and a background thread formats and writes them
+in batches. If the output can't keep up, the oldest messages are dropped
+rather than the game waiting for it.
+
+    logger.info("{} joined {}", name, game)
+
+Arguments are only formatted by the writer, so a disabled message costs
+one comparison.
+"""
+import os, sys, time, atexit, threading
+from collections import deque
+
+DEBUG = 10  # includes every message sent to every player
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+levels = {name.lower(): level for level, name in level_names.items()}
+
+class Logger:
+    def __init__(self, level=INFO, stream=None, size=65536, interval=0.1):
+        self.level = level
+        self.stream = stream  # sys.stdout if None, looked up when writing
+        # deque's append and popleft are atomic, so the game and the writer
+        # share it without a lock. When it is full, append drops the oldest.
+        self.ring = deque(maxlen=size)
+        self.dropped = 0
+        self.interval = interval
+        self.writer = None
+        self.writer_pid = None
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1
+            self.ring.append((time.time(), level, message, args))
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+    def start(self):
+        """
+        Starts the writer thread, if this process doesn't have one.
+        A forked process has to call this again, as threads aren't copied.
+        """
+        if self.writer_pid == os.getpid() and self.writer.is_alive():
+            return
+        if self.writer_pid is not None and self.writer_pid != os.getpid():
+            self.ring.clear()  # the parent process writes these
+        self.writer_pid = os.getpid()
+        self.writer = threading.Thread(target=self.write_forever, name="quork-log", daemon=True)
+        self.writer.start()
+
+    def write_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes everything in the ring buffer, as one write
+        """
+        lines = []
+        while self.ring:
+            try:
+                created, level, message, args = self.ring.popleft()
+            except IndexError:  # emptied by another flush
+                break
+            if args:
+                message = message.format(*args)
+            lines.append("{}.{:03d} {} {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                  time.localtime(created)),
+                                                    int(created * 1000) % 1000,
+                                                    level_names[level],
+                                                    message))
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            lines.append("{} log messages dropped, the output couldn't keep up\n".format(dropped))
+        if lines:
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("".join(lines))
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+logger = Logger()
+atexit.register(logger.flush)
@@ -1,8 +1,12 @@
-import random
+import os, sys, json, random, marshal, hashlib
+from array import array
 
 class Room:
+    __slots__ = ("name", "objects", "description", "_north", "_west", "_south", "_east",
+                 "id", "links", "exits", "neighbours")
     directions = ("north", "south", "east", "west")
-    rooms = {}
+    direction_index = {d: i for i, d in enumerate(directions)}
+    opposites = {"north": "south", "south": "north", "east": "west", "west": "east"}
     
     def __init__(self, name, objects, description,
                  north=None,west=None,south=None,east=None):
@@ -14,12 +18,16 @@ class Room:
         self._south = south
         self._east = east
 
+        # Set by `compile_rooms`
+        self.id = None
+        self.links = (None,) * len(Room.directions)  # the room in each direction, or None
+        self.exits = ()         # (direction, room) for each exit
+        self.neighbours = ()
+
     def _get_room(self, direction):
-        try:
-            return Room.rooms[getattr(self, "_"+direction)]
-        except KeyError:
-            return None
+        return self.links[Room.direction_index[direction]]
 
+    # Changing an exit takes effect when the rooms are next compiled
     @property
     def north(self):
         return self._get_room("north")
@@ -53,11 +61,7 @@ class Room:
         self._east = value
         
     def adjacent_rooms(self):
-        return [getattr(self, direction) for direction in Room.directions]
-
-    @classmethod
-    def random_room(self):
-        return random.choice(list(Room.rooms.values()))
+        return list(self.neighbours)
         
     def __repr__(self):
         return "Room({}, {}, {}, north={}, west={}, south={}, east={})".format(*map(repr, (self.name,
@@ -69,71 +73,426 @@ class Room:
                                                                                            self._east)))
 
 
-beige_display =\
-"""                      Store room
-                            |
-Mirror corridor----------Laboratory---Green wallpaper corridor
-     |                                      |
-Boat painting corridor---Office-------Bin corridor
-     |                      |               |
-Cactus corridor----------Fountain-----Orange wallpaper corricor
-     |                      |               |
-Featureless corridor-----Library------Window corridor
-     |                                      |
-Fish corridor------------Kitchen------Carpetless corridor
-                            |
-                         Toilet"""
-
-beige_rooms = {
-        "laboratory": Room("the laboratory",[],
-                      "A disused laboratory. It's all sciencey.",
-                      north="store room",west="corridor1",east="corridor2"),
-        "store room": Room("the store room",[],
-                      "An empty store room. Out of a window, you can see a distant hill.",
-                      south="laboratory"),
-        "corridor1": Room("a corridor",[],
-                      "On the wall is a large mirror.",
-                      east="laboratory",south="corridor3"),
-        "corridor2": Room("a corridor",[],
-                      "The wallpaper is green and tasteless.",
-                      west="laboratory",south="corridor4"),
-        "corridor3": Room("a corridor",[],
-                      "A painting of a boat is on the wall.",
-                      north="corridor1",east="office",south="corridor5"),
-        "corridor5": Room("a corridor",[],
-                      "A cactus is mounted on the wall.",
-                      north="corridor3",east="fountain",south="corridor7"),
-        "corridor7": Room("a corridor",[],
-                      "It has no features.",
-                      north="corridor5",east="library",south="corridor9"),
-        "corridor9": Room("a corridor",[],
-                      "A fish is stuck to the wall with a spike.",
-                      north="corridor7",east="kitchen"),
-        "corridor4": Room("a corridor",[],
-                      "A bin is here.",
-                      north="corridor2",west="office",south="corridor6"),
-        "corridor6": Room("a corridor",[],
-                      "A corridor. The wallpaper is orange and smells.",
-                      north="corridor4",west="fountain",south="corridor8"),
-        "corridor8": Room("a corridor",[],
-                      "Out of a window, you can see a distant valley.",
-                      north="corridor6",west="library",south="corridor10"),
-        "corridor10": Room("a corridor",[],
-                      "It has no carpet.",
-                      north="corridor8",west="kitchen"),
-        "office": Room("the office",[],
-                      "An office. A desk with papers all over it is in the corner. It feels Kafkaesque.",
-                      west="corridor3",east="corridor4",south="fountain"),
-        "fountain": Room("the room with a fountain",[],
-                      "A room with an ornate, but broken fountain in it. It feels somewhat central.",
-                      north="office",west="corridor5",east="corridor6",south="library"),
-        "library": Room("the library",[],
-                      "A library, with bookshelves lining the walls. On close inspection, all the books are biographies of Morrissey.",
-                      north="fountain",west="corridor7",east="corridor8"),
-        "kitchen": Room("the kitchen",[],
-                      "An old kitchen, with what looks like old cooking equipment in it (surprising!)",
-                      south="toilet",west="corridor9",east="corridor10"),
-        "toilet": Room("a toilet",[],
-                      "A toilet, with a broken sink. There is some inane graffiti on the wall.",
-                      north="kitchen")
-        }
+def compile_rooms(rooms):
+    """
+    Numbers a dict of rooms and links them to each other.
+    Returns a list of the rooms, indexed by `room.id`, and an adjacency table,
+    where `adjacency[room.id * 4 + i]` is the id of the room in direction
+    `Room.directions[i]`, or -1 if there isn't one.
+    """
+    room_list = list(rooms.values())
+    for number, room in enumerate(room_list):
+        room.id = number
+    exits = len(Room.directions)
+    adjacency = array("i", [-1]) * (len(room_list) * exits)
+    for room in room_list:
+        for index, direction in enumerate(Room.directions):
+            linked = rooms.get(getattr(room, "_" + direction))
+            if linked is not None:
+                adjacency[room.id * exits + index] = linked.id
+    link_rooms(room_list, adjacency)
+    return room_list, adjacency
+
+def link_rooms(room_list, adjacency):
+    """
+    Sets the links, exits and neighbours of each numbered room
+    from an adjacency table
+    """
+    exits = len(Room.directions)
+    for room in room_list:
+        links = tuple(room_list[linked] if linked >= 0 else None
+                      for linked in adjacency[room.id * exits:(room.id + 1) * exits])
+        room.links = links
+        room.exits = tuple((d, r) for d, r in zip(Room.directions, links) if r is not None)
+        room.neighbours = tuple(r for d, r in room.exits)
+
+FAR = 255  # in a distance table, unreachable or more than 254 rooms away
+
+def distance_table(room_count, adjacency):
+    """
+    Does a breadth first search from every room.
+    Returns the number of moves between every pair of rooms, where
+    `table[a * room_count + b]` is the distance from room a to room b, or FAR.
+    """
+    exits = len(Room.directions)
+    neighbours = [[n for n in adjacency[room_id * exits:(room_id + 1) * exits] if n >= 0]
+                  for room_id in range(room_count)]
+    rows = []
+    for start in range(room_count):
+        row = bytearray([FAR]) * room_count
+        row[start] = 0
+        frontier = [start]
+        hops = 0
+        while frontier and hops < FAR - 1:
+            hops += 1
+            next_frontier = []
+            for room_id in frontier:
+                for neighbour in neighbours[room_id]:
+                    if row[neighbour] == FAR:
+                        row[neighbour] = hops
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        rows.append(row)
+    return array("B", b"".join(rows))
+
+
+class Map:
+    # Above this many rooms, the distance table would be too big (it takes
+    # a byte for every pair of rooms), so distances are searched for instead
+    dense_limit = 2048
+
+    def __init__(self, name, rooms, display, description, compiled=None):
+        """
+        `compiled` is (room_list, adjacency, distances) from an earlier
+        compile of the same rooms, e.g. from the cache kept by `load_map`.
+        """
+        self.name = name
+        self.rooms = rooms
+        self.display = display
+        self.description = description
+        if compiled is None:
+            self.room_list, self.adjacency = compile_rooms(rooms)
+            if len(self.room_list) <= self.dense_limit:
+                self.distances = distance_table(len(self.room_list), self.adjacency)
+            else:
+                self.distances = None
+        else:
+            self.room_list, self.adjacency, self.distances = compiled
+            for number, room in enumerate(self.room_list):
+                room.id = number
+            link_rooms(self.room_list, self.adjacency)
+        self._nearby = {}  # k -> {room id: (distance, room) for the rooms within k moves}
+        self._back_links = None  # for flow_field, made the first time it is used
+
+    def digest(self):
+        """
+        A hash of how the rooms are linked, to tell whether two Maps are the same
+        """
+        return hashlib.blake2b(self.adjacency.tobytes(), digest_size=16).digest()
+
+    def search(self, start, limit, goal=None):
+        """
+        Returns (distance, room id) for the rooms within `limit` moves of
+        room id `start`, nearest first, stopping early if it finds `goal`.
+        """
+        exits = len(Room.directions)
+        adjacency = self.adjacency
+        found = [(0, start)]
+        seen = {start}
+        frontier = [start]
+        hops = 0
+        while frontier and hops < limit and goal not in seen:
+            hops += 1
+            next_frontier = []
+            for room_id in frontier:
+                for neighbour in adjacency[room_id * exits:(room_id + 1) * exits]:
+                    if neighbour >= 0 and neighbour not in seen:
+                        seen.add(neighbour)
+                        found.append((hops, neighbour))
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        return found
+
+    def distance(self, a, b, limit=FAR):
+        """
+        The number of moves from room a to room b (Rooms or ids), or FAR.
+        On maps too big for a distance table, it is also FAR if it is more
+        than `limit` moves.
+        """
+        if isinstance(a, Room):
+            a, b = a.id, b.id
+        if self.distances is not None:
+            return self.distances[a * len(self.room_list) + b]
+        for hops, room_id in reversed(self.search(a, limit, b)):
+            if room_id == b:
+                return hops
+        return FAR
+
+    def nearby(self, room, k):
+        """
+        Returns (distance, room) for every room within k moves of `room`,
+        nearest first. Worked out once for each room and k.
+        """
+        nearby = self._nearby.setdefault(k, {})
+        if room.id not in nearby:
+            nearby[room.id] = tuple((hops, self.room_list[room_id])
+                                    for hops, room_id in self.search(room.id, k))
+        return nearby[room.id]
+
+    def random_room(self, rng=random):
+        return rng.choice(self.room_list)
+
+    def flow_field(self, sources):
+        """
+        Does one breadth first search from all of `sources` (room ids) at once.
+        Returns the distance from each room to the nearest source, or
+        `len(self.room_list)` if none can be reached, and the index in
+        `Room.directions` of the way to go from each room to get there,
+        or -1 if it is a source or there is no way.
+        """
+        if self._back_links is None:
+            # (neighbour, the index of the way back from it) for each room,
+            # as rooms are linked both ways and the search goes back the way it came
+            back = [Room.direction_index[Room.opposites[d]] for d in Room.directions]
+            self._back_links = [tuple((r.id, back[Room.direction_index[d]]) for d, r in room.exits)
+                                for room in self.room_list]
+        back_links = self._back_links
+        unreachable = len(self.room_list)
+        distance = [unreachable] * unreachable
+        steps = [-1] * unreachable
+        frontier = sorted(sources)  # so ties go the same way whatever order they come in
+        for room_id in frontier:
+            distance[room_id] = 0
+        hops = 0
+        while frontier:
+            hops += 1
+            next_frontier = []
+            for room_id in frontier:
+                for neighbour, way in back_links[room_id]:
+                    if distance[neighbour] == unreachable:
+                        distance[neighbour] = hops
+                        steps[neighbour] = way
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        distance = array("i", distance)
+        steps = array("i", steps)
+        return distance, steps
+
+    def __str__(self):
+        return self.name
+
+
+class MapError(ValueError):
+    pass
+
+def parse_map(data, source="map"):
+    """
+    Builds a Map from the contents of a map file, checking it first.
+    Raises MapError listing everything that is wrong with it.
+    """
+    if not isinstance(data, dict):
+        raise MapError("{} is not a valid map: it must be a JSON object".format(source))
+    problems = []
+    for field in ("name", "description"):
+        if not isinstance(data.get(field), str):
+            problems.append("'{}' must be a string".format(field))
+    display = data.get("display", "")
+    if isinstance(display, list) and all(isinstance(line, str) for line in display):
+        display = "\n".join(display)
+    elif not isinstance(display, str):
+        problems.append("'display' must be a string or a list of strings")
+    rooms = data.get("rooms")
+    if not isinstance(rooms, dict) or not rooms:
+        problems.append("'rooms' must be an object with at least one room in it")
+        rooms = {}
+
+    def exits_of(key):
+        exits = rooms[key].get("exits", {}) if isinstance(rooms[key], dict) else {}
+        return exits if isinstance(exits, dict) else {}
+
+    for key, room in rooms.items():
+        if not isinstance(room, dict):
+            problems.append("room '{}' must be an object".format(key))
+            continue
+        for field in ("name", "description"):
+            if not isinstance(room.get(field), str):
+                problems.append("room '{}' needs a '{}' string".format(key, field))
+        if not isinstance(room.get("objects", []), list):
+            problems.append("room '{}' has 'objects' that isn't a list".format(key))
+        if not isinstance(room.get("exits", {}), dict):
+            problems.append("room '{}' has 'exits' that isn't an object".format(key))
+        for direction, target in exits_of(key).items():
+            if direction not in Room.direction_index:
+                problems.append("room '{}' has an exit to '{}', which isn't a direction".format(key,
+                                                                                            direction))
+            elif not isinstance(target, str):
+                problems.append("room '{}' leads {} to {}, which isn't a room name".format(
+                    key, direction, json.dumps(target)))
+            elif target not in rooms:
+                problems.append("room '{}' leads {} to '{}', which doesn't exist".format(key, direction,
+                                                                                     target))
+            elif target == key:
+                problems.append("room '{}' leads {} to itself".format(key, direction))
+            elif exits_of(target).get(Room.opposites[direction]) != key:
+                problems.append("room '{}' leads {} to '{}', but '{}' doesn't lead {} back".format(
+                    key, direction, target, target, Room.opposites[direction]))
+    if problems:
+        raise MapError("{} is not a valid map:\n{}".format(source, "\n".join("  " + problem
+                                                                          for problem in problems)))
+
+    return Map(data["name"],
+               {key: Room(room["name"], room.get("objects", []), room["description"], **room.get("exits", {}))
+                for key, room in rooms.items()},
+               display, data["description"])
+
+# Bump when the layout of cached maps changes
+CACHE_VERSION = 1
+
+def cache_path(path):
+    directory, file_name = os.path.split(path)
+    return os.path.join(directory, "__cache__",
+                        "{}.{}.qmap".format(os.path.splitext(file_name)[0], sys.implementation.cache_tag))
+
+def load_map(path, use_cache=True):
+    """
+    Loads a map file. The compiled map is cached in a __cache__ directory
+    next to it, and used instead while the file is unchanged.
+    """
+    with open(path, "rb") as map_file:
+        source = map_file.read()
+    digest = hashlib.sha1(source).hexdigest()
+    layout = (sys.byteorder, array("i").itemsize)
+    if use_cache:
+        try:
+            with open(cache_path(path), "rb") as cache_file:
+                cached = marshal.load(cache_file)
+            if (cached["version"], cached["source"], cached["layout"]) == (CACHE_VERSION, digest, layout):
+                return map_from_cache(cached)
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            pass  # missing, stale or damaged, so start again
+
+    try:
+        data = json.loads(source.decode("utf-8"))
+    except ValueError as e:
+        raise MapError("{} is not valid JSON: {}".format(path, e))
+    game_map = parse_map(data, path)
+
+    if use_cache:
+        cached = {"version": CACHE_VERSION, "source": digest, "layout": layout,
+                  "name": game_map.name, "description": game_map.description,
+                  "display": game_map.display,
+                  "rooms": [(key, room.name, room.objects, room.description)
+                            for key, room in game_map.rooms.items()],
+                  "adjacency": game_map.adjacency.tobytes(),
+                  "distances": None if game_map.distances is None else game_map.distances.tobytes()}
+        try:
+            os.makedirs(os.path.dirname(cache_path(path)), exist_ok=True)
+            temporary = cache_path(path) + ".{}.tmp".format(os.getpid())
+            with open(temporary, "wb") as cache_file:
+                marshal.dump(cached, cache_file)
+            os.replace(temporary, cache_path(path))
+        except OSError:
+            pass  # e.g. a read only directory, so just don't cache it
+    return game_map
+
+def map_from_cache(cached):
+    keys = [key for key, name, objects, description in cached["rooms"]]
+    adjacency = array("i")
+    adjacency.frombytes(cached["adjacency"])
+    distances = None
+    if cached["distances"] is not None:
+        distances = array("B")
+        distances.frombytes(cached["distances"])
+
+    exits = len(Room.directions)
+    rooms = {}
+    for number, (key, name, objects, description) in enumerate(cached["rooms"]):
+        links = {d: keys[linked] for d, linked in zip(Room.directions,
+                                                      adjacency[number * exits:(number + 1) * exits])
+                 if linked >= 0}
+        rooms[key] = Room(name, objects, description, **links)
+    return Map(cached["name"], rooms, cached["display"], cached["description"],
+               compiled=(list(rooms.values()), adjacency, distances))
+
+def generate_map(kind, width, height, seed=None, loops=0.1):
+    """
+    Builds a `width` by `height` grid of rooms.
+    In a "grid" every room leads to the rooms beside it. A "maze" is a
+    random spanning tree of the grid, so every room can be reached, with a
+    fraction `loops` of its walls knocked through, so there is more than
+    one way around. A maze's seed is part of its name, and one is picked
+    if it isn't given, so the same maze can be made again.
+    """
+    if width < 1 or height < 1:
+        raise MapError("A map needs at least one room, not {}x{}".format(width, height))
+    if seed is None:
+        seed = random.getrandbits(32)
+    seed = str(seed)  # as it would be in a spec, e.g. maze:100x100:seed
+    rng = random.Random(seed)
+    steps = {"north": (0, -1), "south": (0, 1), "east": (1, 0), "west": (-1, 0)}
+    links = {(x, y): {} for y in range(height) for x in range(width)}
+
+    def link(cell, direction):
+        x, y = cell
+        dx, dy = steps[direction]
+        links[cell][direction] = (x + dx, y + dy)
+        links[(x + dx, y + dy)][Room.opposites[direction]] = cell
+
+    def walls(cell):
+        x, y = cell
+        return [d for d, (dx, dy) in steps.items()
+                if (x + dx, y + dy) in links and d not in links[cell]]
+
+    if kind == "grid":
+        for cell in links:
+            for direction in ("south", "east"):
+                if direction in walls(cell):
+                    link(cell, direction)
+    elif kind == "maze":
+        # A depth first search that knocks through to cells it hasn't visited
+        visited = {(0, 0)}
+        path = [(0, 0)]
+        while path:
+            x, y = cell = path[-1]
+            unvisited = [d for d in walls(cell)
+                         if (x + steps[d][0], y + steps[d][1]) not in visited]
+            if unvisited:
+                direction = rng.choice(unvisited)
+                link(cell, direction)
+                visited.add(links[cell][direction])
+                path.append(links[cell][direction])
+            else:
+                path.pop()
+        for cell in links:
+            for direction in walls(cell):
+                if rng.random() < loops / 2:  # each wall is seen from both sides
+                    link(cell, direction)
+    else:
+        raise MapError("Unknown kind of map '{}', expected grid or maze".format(kind))
+
+    def key(cell):
+        return "{},{}".format(*cell)
+    rooms = {key(cell): Room("room {}".format(key(cell)), [],
+                             "Room {} of a {} by {} {}.".format(key(cell), width, height, kind),
+                             **{d: key(linked) for d, linked in exits.items()})
+             for cell, exits in links.items()}
+
+    if width <= 40 and height <= 40:
+        lines = []
+        for y in range(height):
+            lines.append("".join("o" + ("--" if "east" in links[(x, y)] else "  ") for x in range(width)))
+            lines.append("".join(("|" if "south" in links[(x, y)] else " ") + "  " for x in range(width)))
+        display = "\n".join(line.rstrip() for line in lines).rstrip()
+    else:
+        display = "A {} by {} {}, too big to draw.".format(width, height, kind)
+    name = "{} {}x{}".format(kind.capitalize(), width, height)
+    if kind == "maze":
+        name += " seed {}".format(seed)
+    return Map(name, rooms, display,
+               "A generated {} of {} rooms.".format(kind, width * height))
+
+def find_map(spec):
+    """
+    Returns the Map for `spec`, which is the path of a map file,
+    or e.g. "maze:100x100" or "grid:20x30:seed" for a generated map.
+    """
+    kind, _, size = spec.partition(":")
+    if kind in ("grid", "maze") and size:
+        size, _, seed = size.partition(":")
+        try:
+            width, height = map(int, size.split("x"))
+        except ValueError:
+            raise MapError("Expected a size like 100x100, not '{}'".format(size))
+        return generate_map(kind, width, height, seed or None)
+    return load_map(spec)
+
+MAPS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "maps")
+
+def __getattr__(name):
+    # `quork_maps.beige` is loaded the first time it is used,
+    # so importing the game doesn't read or write any files
+    if name == "beige":
+        global beige
+        beige = load_map(os.path.join(MAPS_DIRECTORY, "beige.json"))
+        return beige
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
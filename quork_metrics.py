@@ -0,0 +1,92 @@
+"""
+Counters and histograms for finding out where a server spends its time.
+
+Everything is recorded in `metrics`, one per process. Recording is a dict
+lookup and an addition or two, so it is cheap enough to leave on all the time.
+"""
+import time
+from collections import defaultdict
+
+class Histogram:
+    """
+    Durations in buckets of powers of two microseconds,
+    i.e. bucket n holds durations of less than 2 ** n microseconds.
+    """
+    buckets = 24  # the last bucket holds everything over about 8 seconds
+
+    def __init__(self):
+        self.counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[min(int(seconds * 1000000).bit_length(), self.buckets - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction
+        of the durations, in seconds.
+        """
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(2 ** bucket / 1000000, self.max)
+        return self.max
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return "count={} mean_us={:.0f} p50_us={:.0f} p99_us={:.0f} max_us={:.0f}".format(
+            self.count, mean * 1000000, self.percentile(0.5) * 1000000,
+            self.percentile(0.99) * 1000000, self.max * 1000000)
+
+class Metrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {}    # name -> function returning the current value
+        self.sections = []  # functions returning extra lines for the report
+
+    def reset(self):
+        """
+        Starts again from nothing, keeping the gauges and sections,
+        e.g. in a process forked from one that had been recording
+        """
+        self.started = time.monotonic()
+        self.counters.clear()
+        self.histograms.clear()
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def record(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def report(self):
+        """
+        Returns everything recorded so far, as lines of text
+        """
+        lines = ["uptime_s {:.0f}".format(time.monotonic() - self.started)]
+        for name, function in sorted(self.gauges.items()):
+            lines.append("{} {}".format(name, function()))
+        for name, value in sorted(self.counters.items()):
+            lines.append("{} {}".format(name, value))
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append("{} {}".format(name, histogram.summary()))
+        for section in self.sections:
+            lines.extend(section())
+        return lines
+
+metrics = Metrics()
@@ -0,0 +1,68 @@
+"""
+The Quork wire protocol.
+
+Version 2 sends each message as a frame: a varint length header followed by
+that many bytes of UTF-8 text. Frames may be split across or packed into
+reads, so every connection keeps a FrameBuffer to reassemble them.
+
+The server's first frame is always GREETING, so a client can tell straight
+away whether it speaks the same version.
+"""
+
+PROTOCOL_VERSION = 2
+GREETING = "Quork protocol {}".format(PROTOCOL_VERSION)
+MAX_FRAME_SIZE = 1 << 20
+
+def encode_varint(number):
+    header = bytearray()
+    while number > 0x7f:
+        header.append((number & 0x7f) | 0x80)
+        number >>= 7
+    header.append(number)
+    return bytes(header)
+
+def encode_frame(message):
+    payload = message.encode("utf-8")
+    return encode_varint(len(payload)) + payload
+
+MAX_HEADER_SIZE = len(encode_varint(MAX_FRAME_SIZE))
+
+class FrameBuffer:
+    """
+    Collects received bytes and splits them into whole messages.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds received bytes, and returns a list of every message completed by them.
+        """
+        self.buffer += data
+        messages = []
+        position = 0
+        end = len(self.buffer)
+        while position < end:
+            length = 0
+            shift = 0
+            header_end = position
+            while header_end < end:
+                byte = self.buffer[header_end]
+                header_end += 1
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+                if header_end - position == MAX_HEADER_SIZE:
+                    # so a header that never ends can't grow the buffer forever
+                    raise ValueError("Frame header is too long")
+            else:
+                break  # the header itself is incomplete
+            if length > MAX_FRAME_SIZE:
+                raise ValueError("Frame of {} bytes is too long".format(length))
+            if header_end + length > end:
+                break
+            messages.append(self.buffer[header_end:header_end + length].decode("utf-8"))
+            position = header_end + length
+        del self.buffer[:position]
+        return messages
@@ -0,0 +1,121 @@
+"""
+Replays a journal written by `server.py --journal`, without any sockets or
+waiting between ticks, and checks each match ends up as it did on the server.
+
+    $ python quork_replay.py matches.journal --map maze:100x100:7
+
+Matches on maps other than Beige need the same `--map` the server was given,
+with the seed a maze was given, or the one in its name, e.g. "Maze 100x100 seed 7".
+As well as finding out how a match got into a strange state, a journal of
+real matches makes a realistic benchmark, as it is replayed as fast as possible.
+"""
+import sys, time, argparse
+
+import quork_maps
+import quork_game
+from quork_sim import Simulation
+from quork_journal import (read_journal, outcome, verbs, variable_names,
+                           START, JOIN, COMMAND, LEAVE, END, CHECK)
+
+class ReplayError(Exception):
+    pass
+
+class Replay:
+    """
+    A match being replayed, how it ended on the server, if the journal says,
+    and the first tick the replay was found to be different, if it was
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.recorded = None
+        self.diverged = None
+
+    def check(self, tick, recorded):
+        if self.diverged is None and recorded != outcome(self.sim.game):
+            self.diverged = tick
+
+    def catch_up(self, tick):
+        game = self.sim.game
+        if game.ticks < tick:
+            while game.ticks < tick:
+                game.tick()
+            self.sim.drain()
+
+def replay(records, maps):
+    """
+    Plays out journal records. `maps` is a dict of map names to Maps.
+    Returns a dict of `(session, match)` to Replay, and how many commands there were.
+    """
+    replays = {}
+    commands = 0
+    for session, kind, tick, match, slot, fields in records:
+        if kind == START:
+            seed, grues, simultaneous, map_name, map_digest, game_type = fields
+            if map_name not in maps:
+                raise ReplayError("Match {} was on {}, give its --map".format(match, map_name))
+            if maps[map_name].digest() != map_digest:
+                raise ReplayError("The {} given isn't the one match {} was played on, "
+                                  "has it been changed?".format(map_name, match))
+            replays[session, match] = Replay(Simulation(maps[map_name],
+                                                        getattr(quork_game, game_type),
+                                                        grues, simultaneous, seed))
+            continue
+        current = replays[session, match]
+        current.catch_up(tick)
+        sim = current.sim
+        if kind == COMMAND:
+            verb, arguments = fields
+            entity = sim.game.entities.entities[slot]
+            if entity is None:
+                raise ReplayError("Match {} tick {}: nobody in slot {} to {}".format(
+                    match, tick, slot, verbs[verb].words[0]))
+            sim.game.act(entity, verbs[verb].handler, dict(zip(variable_names[verb], arguments)))
+            commands += 1
+        elif kind == JOIN:
+            room, name = fields
+            player = sim.add_player(name)
+            if player.slot != slot or player.room.id != room:
+                raise ReplayError("Match {} tick {}: {} joined in slot {} room {} on the "
+                                  "server, but slot {} room {} here".format(
+                                      match, tick, name, slot, room, player.slot, player.room.id))
+        elif kind == LEAVE:
+            sim.remove_player(sim.game.entities.entities[slot])
+        elif kind == CHECK:
+            current.check(tick, fields[0])
+        elif kind == END:
+            (current.recorded,) = fields
+            current.check(tick, current.recorded)
+    return replays, commands
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Replay a server's journal.")
+    arg_parser.add_argument("journal")
+    arg_parser.add_argument("--map", action="append", dest="maps", metavar="MAP", default=[],
+                            help="a map the server was given, as a file or e.g. maze:100x100:seed")
+    args = arg_parser.parse_args()
+    maps = {quork_maps.beige.name: quork_maps.beige}
+    for spec in args.maps:
+        game_map = quork_maps.find_map(spec)
+        maps[game_map.name] = game_map
+
+    records = list(read_journal(args.journal))
+    start = time.perf_counter()
+    replays, commands = replay(records, maps)
+    elapsed = time.perf_counter() - start
+
+    failed = False
+    for (session, match), current in sorted(replays.items()):
+        game = current.sim.game
+        if current.diverged is not None:
+            result = "DIFFERENT from the server by tick {}".format(current.diverged)
+            failed = True
+        elif current.recorded is None:
+            result = "the same so far, but didn't end in the journal"
+        else:
+            result = "reproduced"
+        print("session {} match {} on {}: {} ticks, {} players, {}".format(
+            session, match, game.map, game.ticks, len(game.players), result))
+    ticks = sum(current.sim.game.ticks for current in replays.values())
+    print("{:,} commands and {:,} ticks in {:.2f}s, {:,.0f} commands per second".format(
+        commands, ticks, elapsed, commands / elapsed if elapsed else 0))
+    sys.exit(1 if failed else 0)
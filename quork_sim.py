@@ -0,0 +1,153 @@
+"""
+Runs matches in memory, without any sockets, so the game can be tested
+and benchmarked on its own.
+
+    $ python quork_sim.py --players 200 --commands 200000
+
+runs microbenchmarks of parsing, movement, combat and ticks, and prints
+how many operations per second each managed.
+"""
+import time, random, argparse
+
+import quork_maps
+from quork_game import Game, Player, Grue, Deathmatch25, parser
+
+class Simulation:
+    """
+    A match whose players are driven directly with command strings.
+    Messages for the players are collected in `player.data` as usual,
+    and thrown away by `drain()`.
+    """
+    def __init__(self, game_map=None, game_type=Deathmatch25, grues=0,
+                 simultaneous=False, seed=None):
+        self.game = Game(game_map or quork_maps.beige, game_type, simultaneous, seed)
+        self.game.spawn_grues(grues)
+        self.messages = 0
+
+    def add_player(self, name=None, room=None):
+        return Player(self.game, name or self.game.new_player_name(),
+                      room or self.game.spawn_room())
+
+    def remove_player(self, player):
+        self.game.remove_player(player)
+
+    def command(self, player, command):
+        player.do(command)
+
+    def tick(self):
+        self.game.tick()
+
+    def drain(self):
+        """
+        Empties every player's pending messages, and returns how many there were
+        """
+        count = 0
+        for p in self.game.players.values():
+            count += len(p.data)
+            p.data = []
+        self.game.messaged.clear()
+        self.messages += count
+        return count
+
+def random_commands(players, count, choices):
+    names = [p.name for p in players]
+    commands = []
+    for _ in range(count):
+        command = random.choice(choices)
+        if "{name}" in command:
+            command = command.format(name=random.choice(names))
+        elif "{direction}" in command:
+            command = command.format(direction=random.choice(quork_maps.Room.directions))
+        commands.append((random.choice(players), command))
+    return commands
+
+def run_commands(sim, commands):
+    start = time.perf_counter()
+    for number, (player, command) in enumerate(commands):
+        player.do(command)
+        if not number % 1000:
+            if sim.game.simultaneous:
+                sim.tick()  # carries out the queued actions
+            sim.drain()
+    if sim.game.simultaneous:
+        sim.tick()
+    return time.perf_counter() - start
+
+def bench_parse(sim, players, count):
+    commands = [command for p, command in random_commands(players, count, (
+        "aim {name}", "aim {name} head", "fire", "shoot", "go {direction}", "look",
+        "say hello everyone", "tell {name} hi", "set name to bob", "nonsense words"))]
+    start = time.perf_counter()
+    for command in commands:
+        parser.parse(command)
+    return time.perf_counter() - start
+
+def bench_movement(sim, players, count):
+    return run_commands(sim, random_commands(players, count, ("go {direction}",)))
+
+def bench_combat(sim, players, count):
+    return run_commands(sim, random_commands(players, count, (
+        "aim {name}", "aim {name} head", "fire", "fire", "fire", "reload")))
+
+def bench_mixed(sim, players, count):
+    return run_commands(sim, random_commands(players, count, (
+        "go {direction}", "go {direction}", "look", "aim {name}", "fire", "fire",
+        "reload", "info", "say gg")))
+
+def bench_tick(sim, players, count):
+    # Give everyone something to check each tick
+    for p in players:
+        p.do("aim {}".format(random.choice(players).name))
+    sim.drain()
+    ticks = max(1, count // len(players))
+    start = time.perf_counter()
+    for _ in range(ticks):
+        sim.tick()
+    elapsed = time.perf_counter() - start
+    sim.drain()
+    return elapsed * count / (ticks * len(players))  # per player update, like the others
+
+def bench_grues(sim, players, count):
+    # Ticks of a match with `count` grues hunting the players, per grue turn
+    sim.game.spawn_grues(count)
+    ticks = 200
+    start = time.perf_counter()
+    for _ in range(ticks):
+        sim.tick()
+        sim.drain()
+    elapsed = time.perf_counter() - start
+    turns = ticks * count / Grue.think_interval
+    return elapsed * count / turns
+
+def bench_respawn(sim, players, count):
+    sim.game.spawn_grues(len(players))
+    start = time.perf_counter()
+    for number in range(count):
+        players[number % len(players)].respawn()
+    return time.perf_counter() - start
+
+benchmarks = {"parse": bench_parse, "movement": bench_movement, "combat": bench_combat,
+              "mixed": bench_mixed, "tick": bench_tick, "grues": bench_grues,
+              "respawn": bench_respawn}
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark the game without a server.")
+    arg_parser.add_argument("--players", type=int, default=100)
+    arg_parser.add_argument("--commands", type=int, default=100000,
+                            help="operations per benchmark (default: %(default)s)")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--map", default=None,
+                            help="a map file, or e.g. maze:100x100 (default: Beige)")
+    arg_parser.add_argument("--simultaneous", action="store_true",
+                            help="queue actions and resolve them each tick")
+    arg_parser.add_argument("benchmarks", nargs="*", choices=[[]] + list(benchmarks),
+                            help="which benchmarks to run (default: all)")
+    args = arg_parser.parse_args()
+    game_map = quork_maps.find_map(args.map) if args.map else quork_maps.beige
+
+    for name in args.benchmarks or benchmarks:
+        random.seed(args.seed)
+        sim = Simulation(game_map, simultaneous=args.simultaneous)
+        players = [sim.add_player() for _ in range(args.players)]
+        elapsed = benchmarks[name](sim, players, args.commands)
+        print("{:<10} {:>12,.0f} per second".format(name, args.commands / elapsed))
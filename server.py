@@ -1,566 +1,599 @@
-import sys, json, socket, select, random
-from operator import attrgetter
+import sys, time, errno, signal, socket, selectors, asyncio, argparse
+from collections import deque
 
-from verb_parser import Parser, Verb, Variable, Remainder
 import quork_maps
-Room = quork_maps.Room
+from quork_game import Game, Deathmatch25, Player, Verbs
+from quork_metrics import metrics
+from quork_log import logger, levels
+from quork_journal import Journal
+from quork_protocol import GREETING, encode_frame, FrameBuffer
+from tick_scheduler import TickScheduler, TokenBucket
 
 if sys.version_info < (3, 0):
     print("""Python version older than 3.0
 The program is unlikely to work, please update.""", file=sys.stderr)
 
-try:
-    from enum import Enum
-except ImportError:
-    print("""Enum module not found.
-Some incorrect behaviour may occur.
-Try updating to Python 3.4,
-or installing the Enum module - `$ pip install enum34`.
-""", file=sys.stderr)
-    class MetaEnum(type):
-        def __new__(cls, clsname, bases, dct):
-            return super(MetaEnum, cls).__new__(cls, clsname, bases, dct)
-        def __iter__(self):
-            for attr in dir(self):
-                if not attr.startswith("__"):
-                    yield attr
-                    
-    class Enum(metaclass=MetaEnum):
-        pass
-
-DEBUG = False
 MOTD = "Welcome to pyTextShooter! Ctrl-c to enter a command. Enter 'help' for a list of commands."
+LOCAL_HOSTS = ("127.0.0.1", "::1")  # players connecting from these can use admin verbs
 
-def get_direction(direction, room, no_room, unknown_direction):
-    if direction not in Room.directions:
-        return (unknown_direction, None)
-    elif getattr(room, direction) is None:
-        return (no_room, None)
-    else:
-        return (False, getattr(room, direction))                                                                               
-
-class InjuryCause(Enum):
-    shot = 1
-    game_rule = 2
-
-class InjuryResult(Enum):
-    kill = 1
-    no_kill = 2
-
-class Gun:
-    max_ammo = None
-    normal_damage = None
-    headshot_damage = None
-    success_message = "You shot {name} for {damage} damage!"
-    no_ammo_message = "You don't have any ammo!"
-    
-    def __init__(self, ammo):
-        self.ammo = ammo
-
-    def shoot(self, other, aim_state):
-        """
-        Attempts to shoot an Entity.
-        Returns a message for the shooter.
-        """
-        if self.ammo > 0:
-            self.ammo -= 1
-            if aim_state == AimState.head:
-                damage = self.headshot_damage
-            elif aim_state == AimState.body:
-                damage = self.normal_damage
-            else:
-                return "You aren't aiming at anything the Universe can understand."
-            injury_result = other.injure(damage, InjuryCause.shot)
-            return (injury_result, self.success_message.format(name=other.name,
-                                               damage=damage))
-        else:
-            return (None, self.no_ammo_message)
-
-    def __repr__(self):
-        "{}({})".format(type(self).__name__, self.ammo)
-
-class Rifle(Gun):
-    max_ammo = 10
-    normal_damage = 20
-    headshot_damage = 40            
-        
-
-class ItemName:
-    def __init__(self, name, article, plural):
-        self.name = self.name
-        self.article = self.article
-        self.plural = plural
-
-    def string(self, plural=False):
-        if plural:
-            return self.plural
-        else:
-            return self.article + self.name
-
-    def __repr__(self):
-        return "Item({}, {}, {})".format(self.name,
-                                         self.kind,
-                                         self.plural)
-
-class Item:
-    def __init__(self, name):
-        self.name = name
-
-class Map:
-    def __init__(self, name, rooms, display, description):
-        self.name = name
-        self.rooms = rooms
-        self.display = display
-        self.description = description
-        
-
-    def __str__(self):
-        return self.name
-
-class GameType:
-    name = "Base game type"
-    rules = "This isn't a real game type"
-
-    @classmethod
-    def tick(cls):
-        """
-        `game.game_type.tick` is run every time the game loops
-        """
-        pass
-
-class BaseDeathmatch(GameType):
-    name = "Base deathmatch game type"
-    rules = "Kill to gain points."
-
-    max_kills = 0
-
-    @classmethod
-    def tick(cls):
-        """
-        Detect if anyone has 25 kills, if so declare them the winner.
-        """
-        for p in Player.players.values():
-            if p.kills >= cls.max_kills:
-                p.log("Congratulations, you win!")
-                for other_p in Player.players.values():
-                    if other_p != p:
-                        p.log("{} is the winner!".format(p.name))
-                for player in Player.players.values():
-                    p.die(InjuryCause.game_rule)
-                # actually reset the game here
-
-class Deathmatch25(BaseDeathmatch):
-    name = "Deathmatch"
-    rules = "First to 25 kills."
-    max_kills = 25
-
-class Game:
-    def __init__(self, game_map, game_type):
-        self.map = game_map
-        self.game_type = game_type
-        Room.rooms = self.map.rooms
-
-    def __repr__(self):
-        return "Game({}, {})".format(str(self.map), repr(self.game_type))
-
-class Entity:
-    max_health = None
-    
-    def __init__(self, name, room):
-        self.name = name
-        self.room = room
-        self.reset()
-
-    def reset(self):
-        self.health = self.max_health
+class SlowClientError(ConnectionError):
+    pass
 
-    def __repr__(self):
-        return "{}({}, {})".format(type(self).__name__,
-                                   repr(self.name),
-                                   repr(self.room))
-
-
-class AimState(Enum):
-    none = 1
-    body = 2
-    head = 3
-    
-
-class Player(Entity):
-    players = {}
-    
-    max_health = 100
-    start_ammo = 10
-
-    def __init__(self, name, room):
-        super().__init__(name, room)
-        self.kills = 0
-        self.deaths = 0
-        self.data = []
-        self.reset()
-        Player.players[name] = self
-
-    @staticmethod
-    def message_players(players, message, source=None):
-        for p in players:
-            if p != source:
-                p.log(message)
-
-    def log(self, message):
-        """
-        Logs a message to be sent to the Client the Player belongs to
-        """
-        self.data.append(message)
-        print(message)
-
-    def reset(self):
-        self.gun = Rifle(Rifle.max_ammo)
-        self.ammo = self.start_ammo
-        self.aim_state = AimState.none
-        self.target = None
-        self.target_room = None
-        super().reset()
-        
-
-    def in_rooms(self, rooms):
-        return any(self.room == room for room in rooms)
-
-    def die(self, cause):
-        self.log("You were killed!")
-        self.deaths += 1
-        self.room = Room.random_room()
-        self.reset()
+class Client:
+    # Bytes of queued output above which a client's commands stop being read,
+    # and above which it is disconnected
+    throttle_mark = 64 * 1024
+    high_water_mark = 256 * 1024
+
+    # Each client can run `command_burst` commands at once, and `command_rate`
+    # more per second. Commands over that wait for the next ticks, and once
+    # `max_pending` are waiting, the client's input stops being read.
+    command_rate = 10
+    command_burst = 20
+    max_pending = 200
     
-    def injure(self, damage, cause):
-        self.health -= damage
-        self.log("You were shot for {} damage!".format(damage))
-        if self.health <= 0:
-            self.die(cause)
-            return InjuryResult.kill
-        else:
-            return InjuryResult.no_kill
-
-    def aim_at(self, target, aim_state):
-        self.aim_state = aim_state
-        self.target = target
-        if aim_state == AimState.head:
-            self.target_room = target.room
-        else:
-            self.target_room = None
-
-    def aim_base(self, name, success_message, aim_state):
-        unknown_person = "There is nothing called {name}!"
-        out_of_range = "{name} is out of range!"
-        possible_rooms = self.room.adjacent_rooms() + [self.room]
-        if name not in Player.players:
-            self.log(unknown_person.format(name=name))
-        elif Player.players[name].in_rooms(possible_rooms):
-            self.aim_at(Player.players[name], aim_state)
-            self.log(success_message.format(name=name))
-        else:
-            self.log(out_of_range.format(name=name))
-
-    def look_base(self, room):
-        self.log(room.name.capitalize())
-        self.log(room.description)        
-
-    def update(self):
+    def __init__(self, connection, address, game):
+        self.connection = connection
+        self.address = address
+        self.game = game
+        self.received = FrameBuffer()
+        self.outbound = deque()
+        self.outbound_size = 0
+        self.sent = 0  # how much of `self.outbound[0]` has been sent
+        self.pending = deque()  # commands received but not run yet
+        self.budget = TokenBucket(self.command_rate / scheduler.rate, self.command_burst)
+        self.player = Player(game, game.new_player_name(), game.spawn_room())
+        self.player.admin = address[0] in LOCAL_HOSTS
+        game.clients.append(self)
+        clients_by_player[self.player] = self
+        self.player.data.append(encode_frame(GREETING))  # always a frame of its own
+        self.player.log(MOTD)  # which also marks the player as messaged
+
+    def queue_data(self):
         """
-        Called at the start of each cycle
+        Moves the Player's pending messages onto the outbound queue.
+        Runs of messages are sent as one frame, and frames shared by a
+        broadcast are queued as they are, without copying them.
         """
-        if self.aim_state == AimState.head:
-            if self.target_room != self.target.room:  # if the target has moved rooms
-                self.aim_at(None, AimState.none)
-                self.log("Your target has run out of your sights!")
-        elif self.aim_state == AimState.body:
-            if not self.target.in_rooms(self.room.adjacent_rooms() + [self.room]):
-                self.aim_at(None, AimState.none)
-                self.log("Your target has run away!")
-
-            
-    # The following methods correspond directly to commands.
-    # They all return a message for the Player who calls them
-
-    def aim(self, name):
-        self.aim_base(name, "You point your gun at {name}!", AimState.body)
-
-    def aim_head(self, name):
-        self.aim_base(name, "You point your gun at {name}'s head!", AimState.head)
-
-    def fire(self):
-        if self.aim_state != AimState.none:
-            # self.update() guarantees a valid, in range target
-            old_target = self.target
-            result, message = self.gun.shoot(self.target, self.aim_state)
-            self.log(message)
-            if result is not None:  # shooting was successful
-                for p in Player.players.values():
-                    if p != self:
-                        for d in Room.directions:
-                            if getattr(p, d) == self.room:
-                                p.log("You hear a loud bang to the {direction}!".format(d.capitalize()))
-                        if p.room == self.room:
-                            p.log("You hear a loud bang in the room you are in!")
-                
-            if result == InjuryResult.kill:
-                if old_target == self:
-                    self.log("You killed yourself!")
+        if self.player.data:
+            lines = []
+            for message in self.player.data:
+                if isinstance(message, bytes):
+                    if lines:
+                        self.queue(encode_frame("\n".join(lines)))
+                        lines = []
+                    self.queue(message)
                 else:
-                    self.log("You killed {}!".format(self.target.name))
-                    self.target = None
-                    self.aim_state = AimState.none
-                    self.target_room = None
-                    self.kills += 1
-        else:
-            self.log("You aren't aiming at anything!")
-
-    def reload(self):
-        spaces = self.gun.max_ammo - self.gun.ammo
-        if self.ammo == 0:
-            self.log("You have no ammo left in your pockets!")
-        if self.ammo <= spaces:
-            self.gun.ammo += self.ammo
-            self.ammo = 0
-        else:
-            self.gun.ammo = self.gun.max_ammo
-            self.ammo -= spaces
-        self.log("You reloaded {bullets} bullets!".format(bullets=spaces))
-
-    def go(self, direction):
-        message, destination = get_direction(direction, self.room,
-                                             "You can't go that way!",
-                                             "'{}' isn't a direction...".format(direction))
-        if destination:
-            for p in Player.players.values():
-                if p.room == self.room and p != self:
-                    p.log("You hear footsteps leaving the room!")
-            self.room = destination
-            self.log("You went {}!".format(direction))
-            for p in Player.players.values():
-                if p.room == self.room and p != self:
-                    p.log("You hear footsteps entering the room!")
-        else:
-            self.log(message)
-
-    def look(self):
-        self.look_base(self.room)
-        for d in Room.directions:
-            room = getattr(self.room, d)
-            if room:
-                self.log("To the {direction} is {room}.".format(direction=d, room=room.name))
-                
-    def look_direction(self, direction):
-        message, room = get_direction(direction, self.room,
-                                      "There's nothing in that direction!",
-                                      "'{}' isn't a direction".format(direction))
-        if room:
-            self.look_base(room)
-        else:
-            self.log(message)
+                    lines.append(message)
+            if lines:
+                self.queue(encode_frame("\n".join(lines)))
+            self.player.data = []
 
-    def info(self):
-        self.log("You have {} health".format(self.health))
-        self.log("{} ammo in your gun".format(self.gun.ammo))
-        self.log("{} ammo in your pocket".format(self.ammo))
-
-    def stats(self):
-        self.log("{} kills".format(self.kills))
-        self.log("{} deaths".format(self.deaths))
-
-    def say(self, message):
-        Player.message_players(Player.players.values(),
-                               '{} said "{}"'.format(self.name, message),
-                               source=self)
-
-    def tell(self, name, message):
-        try:
-            Player.players[name].log('{} told you "{}"'.format(self.name,
-                                                              message))
-        except KeyError:
-            self.log("Unknown person '{}'".format(name))
-
-    def set_name_to(self, name):
-        if any(c in name for c in "`¬¦!\"£$%^&*()-_=+[{]};:'@#~,<.>/?\\|\n\t "):
-            self.log("Names may not contain punctuation or whitespace!")
-        elif any(p.name == name for p in Player.players.values()):
-            self.log("Someone already has that name!")
-        else:
-            old_name = self.name
-            new_name = name[:3].lower().zfill(3)
-            Player.players[new_name] = self
-            del Player.players[old_name]
-            self.name = new_name
-            self.log("Name changed to '{}'!".format(self.name))
-
-    def list_players(self):
-        self.log("Players:")
-        for name in Player.players:
-            self.log(name)
-
-    def display_map(self):
-        self.log(game.map.display)
-
-    def rules(self):
-        self.log(game.game_type.rules)
-
-    def get_help(self):
-        self.log(help_text)               
-                
-
-class Verbs(Enum):
-    aim = Verb("aim", Variable("name"), desc="aim at someone's body")
-    aim_head = Verb("aim", Variable("name"), "head", desc="aim at someone's head")
-    fire = Verb("fire", desc="fire at whoever you are aiming at")
-    fire.alias("shoot")
-    reload = Verb("reload", desc="reload your gun")
-    go = Verb("go", Variable("direction"), desc="move to an adjacent room")
-    look = Verb("look", desc="look at the room you are in")
-    look_direction = Verb("look", Variable("direction"), desc="look into an adjacent room")
-    info = Verb("info", desc="get info on your health and inventory")
-    stats = Verb("stats", desc="get your kill and death stats")
-    say = Verb("say", Remainder("message"), desc="say something to everyone on the server")
-    tell = Verb("tell", Variable("name"), Remainder("message"), desc="tell an individual something")
-    set_name_to = Verb("set", "name", "to", Variable("name"), desc="change your name")
-    list_players = Verb("list", desc="list all online players")
-    display_map = Verb("map", desc="display the map")
-    get_help = Verb("help", desc="display this")
-    rules = Verb("rules", desc="display the rules of the current game")
-
-    @staticmethod
-    def verb_name(verb):
-        for v in Verbs:
-            if verb == v.value:
-                return v.name
-        else:
-            raise ValueError("Unknown verb {}".format(repr(verb)))
+    def queue(self, frame):
+        self.outbound.append(frame)
+        self.outbound_size += len(frame)
+        if self.outbound_size > self.high_water_mark:
+            raise SlowClientError("{} bytes of output queued".format(self.outbound_size))
 
-    @classmethod
-    def generate_help(cls):
-        return "\n".join(map(lambda v: str(v.value), cls))
+    def throttled(self):
+        return self.outbound_size > self.throttle_mark or len(self.pending) >= self.max_pending
 
-help_text = Verbs.generate_help()
-
-help_text += """
-You can only shoot at someone normally in the room you are in, or an adjacent one.
-However, you can only shoot someone you are aiming at the head at if they are in the same room they were in when you aimed at them.
-Normal shots do 20 damage, and headshots do 40 damage.
-"""
-    
-parser = Parser(list(map(attrgetter("value"), Verbs)))
-
-def send_list(connection, list_):
-    bytes_string = bytes(json.dumps(list(list_)), "ascii")
-    if len(bytes_string) > 4096:
-        raise ValueError("List to send too long")
-    while len(bytes_string) < 4096:
-       bytes_string += b" "
-    connection.send(bytes_string)
-
-def recieve_list(connection):
-    return json.loads(connection.recv(4096).decode("ascii").strip())
-
-class Client:
-    clients = []
-    player_number = 0
-    
-    def __init__(self, connection, address):
-        self.connection = connection
-        self.address = address
-        while str(Client.player_number).zfill(3) in Player.players:
-            Client.player_number += 1
-        self.player = Player(str(Client.player_number).zfill(3), Room.random_room())
-        Client.clients.append(self)
-        self.player.log(MOTD)
+    def queued_bytes(self):
+        return self.outbound_size
 
     def send_data(self):
-        if self.player.data and DEBUG:
-            print(self.player.data)
-        send_list(self.connection, ["\n".join(self.player.data)])
-        self.player.data = []
-        
+        """
+        Sends as much of the outbound queue as the socket will take
+        """
+        try:
+            while self.outbound:
+                frame = self.outbound[0]
+                sent = self.connection.send(memoryview(frame)[self.sent:])
+                self.sent += sent
+                self.outbound_size -= sent
+                metrics.count("bytes_sent", sent)
+                if self.sent < len(frame):
+                    return  # short write, carry on when writable again
+                self.outbound.popleft()
+                self.sent = 0
+                metrics.count("frames_sent")
+        except BlockingIOError:
+            pass
 
     def get_command(self):
-        command = recieve_list(self.connection)[0]
-        if DEBUG:
-            print(command)
-        result = parser.parse(command)
-        if result is not None:
-            verb, variables = result
-            verb_name = Verbs.verb_name(verb)
-            getattr(self.player, verb_name)(**variables)
-            # e.g. if verb is `Verbs.aim_head.value`, then this calls `self.aim_head(name=variables["name"])`
-        else:
-            similar = [v.value for v in Verbs if command.startswith(v.value.words[0])]
-            if similar:
-                for s in similar:
-                    self.player.log("Did you mean '{}'?".format(str(s)))
-            self.player.log("Unknown command '{}'".format(command))
-        
+        data = self.connection.recv(65536)
+        if not data:
+            raise ConnectionResetError("Connection closed by client")
+        self.receive(data)
+
+    def receive(self, data):
+        metrics.count("bytes_received", len(data))
+        commands = self.received.feed(data)
+        metrics.count("frames_received", len(commands))
+        self.pending.extend(commands)
+        self.run_pending()
+
+    def run_pending(self):
+        """
+        Runs as many waiting commands as the client's budget allows
+        """
+        while self.pending and self.budget.take():
+            self.handle_command(self.pending.popleft())
+        if self.pending:
+            metrics.count("commands_deferred")
+
+    def handle_command(self, command):
+        logger.debug("from {}: {}", self.player.name, command)
+        start = time.perf_counter()
+        verb = self.player.do(command)
+        metrics.record("verb." + (Verbs.verb_name(verb) if verb else "unknown"),
+                       time.perf_counter() - start)
 
     def __repr__(self):
         return "Client({}, {}, {})".format(repr(self.connection),
                                            repr(self.address),
                                            repr(self.player))
 
-# currently irrelevant	
-def grue_name(grue_names=[]):
-    letters = "rhgmnsz"
-    while True:
-        name = "".join(random.choice(letters) for _ in range(3))
-        if name not in grue_names:
-            grue_names.append(name)
-            return name
+class AsyncClient(Client):
+    """
+    A Client driven by asyncio streams instead of a raw socket.
+    `connection` is the StreamWriter.
+    """
+    def __init__(self, reader, writer, game):
+        super().__init__(writer, writer.get_extra_info("peername"), game)
+        self.reader = reader
+        self.has_data = asyncio.Event()
+
+    def queue(self, frame):
+        # asyncio's transport buffers the output, and `drain()` waits on it
+        self.connection.write(frame)
+        metrics.count("bytes_sent", len(frame))
+        metrics.count("frames_sent")
+        if self.queued_bytes() > self.high_water_mark:
+            raise SlowClientError("Too much output queued")
+
+    def queued_bytes(self):
+        return self.connection.transport.get_write_buffer_size()
+
+    def wake_writer(self):
+        if self.player.data:
+            self.has_data.set()
+
+    async def read_commands(self):
+        while True:
+            await self.connection.drain()  # don't read commands while output is backed up
+            while len(self.pending) >= self.max_pending:
+                await asyncio.sleep(scheduler.interval)  # or while too many are waiting
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionResetError("Connection closed by client")
+            self.receive(data)
+            for c in messaged_clients():  # e.g. everyone who heard this client
+                c.wake_writer()
+
+    async def write_data(self):
+        while True:
+            await self.has_data.wait()
+            self.has_data.clear()
+            self.queue_data()
+            await self.connection.drain()
+
+# New matches cycle through these (Map, GameType) pairs, or play on Beige if None
+match_rotation = None
+matches = []
+MAX_PLAYERS = 16  # per match
+GRUES = 0  # computer controlled enemies in each match
+SIMULTANEOUS = False  # resolve each tick's actions together, see Game
+journal = None  # a Journal that every match is recorded in, if any
+
+def find_match():
+    """
+    Returns the fullest match with space for another player,
+    starting a new one if they are all full.
+    """
+    open_matches = [m for m in matches if len(m.clients) < MAX_PLAYERS]
+    if open_matches:
+        return max(open_matches, key=lambda m: len(m.clients))
+    rotation = match_rotation or [(quork_maps.beige, Deathmatch25)]
+    game_map, game_type = rotation[len(matches) % len(rotation)]
+    match = Game(game_map, game_type, SIMULTANEOUS)
+    match.spawn_grues(GRUES)
+    if journal is not None:
+        journal.start(match)
+    matches.append(match)
+    return match
+
+clients_by_player = {}
+
+def all_clients():
+    for match in matches:
+        yield from match.clients
+
+def messaged_clients():
+    """
+    Returns the clients of the players who have been sent messages since
+    the last call, so clients with nothing to send needn't be looked at
+    """
+    clients = []
+    for match in matches:
+        if match.messaged:
+            for player in match.messaged:
+                client = clients_by_player.get(player)
+                if client is not None:
+                    clients.append(client)
+            match.messaged.clear()
+    return clients
+
+def client_stats():
+    return ["client {} {} queued_bytes={} pending_commands={}".format(c.player.name, c.address[0],
+                                                                      c.queued_bytes(), len(c.pending))
+            for c in all_clients()]
+
+metrics.gauge("clients", lambda: sum(len(m.clients) for m in matches))
+metrics.gauge("matches", lambda: len(matches))
+metrics.gauge("queued_bytes", lambda: sum(c.queued_bytes() for c in all_clients()))
+metrics.gauge("pending_commands", lambda: sum(len(c.pending) for c in all_clients()))
+metrics.gauge("queued_bytes_max", lambda: max((c.queued_bytes() for c in all_clients()), default=0))
+metrics.sections.append(client_stats)
 
 def delete_client(client):
-    print("A client disconnected :-(")
-    Client.clients.remove(client)
-    del Player.players[client.player.name]
-
-game = Game(Map("Beige", quork_maps.beige_rooms, quork_maps.beige_display, "A small, bland map."),
-            Deathmatch25)
-
-print(socket.gethostbyname(socket.gethostname()))
+    logger.info("{} disconnected from {}", client.player.name, client.address[0])
+    game = client.game
+    game.clients.remove(client)
+    del clients_by_player[client.player]
+    if not game.clients and game.journal is not None:
+        game.journal.end(game)  # while the last player is still there to check
+    game.remove_player(client.player)
+    if not game.clients:  # nothing left to run
+        matches.remove(game)
+
+def announce_join(client):
+    if len(client.game.clients) == 1:
+        logger.info("{} started a new match on {}", client.player.name, client.game.map)
+    else:
+        Player.message_players(client.game.players.values(), "A new player joined!",
+                               source=client.player)
+
+def game_tick():
+    for match in matches:
+        match.tick()
+        # Top up every client's budget, and run commands left over from earlier.
+        # Who goes first changes each tick, so nobody is always last.
+        clients = match.clients
+        if clients:
+            first = scheduler.ticks % len(clients)
+            for c in clients[first:] + clients[:first]:
+                c.budget.refill()
+                if c.pending:
+                    c.run_pending()
 
 HOST = ''
 PORT = 13337
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.bind((HOST, PORT))
-
-s.listen(1)
-
-Client(*s.accept())
-print("The first player joined!")
-s.settimeout(0)
-
-while True:
-    try:
-        Client(*s.accept())
-        print("A new player joined!")
-        for p in Player.players.values():
-            if p != Client.clients[-1].player:
-                p.log("A new player joined!")
-    except IOError:
-        pass
-
-    game.game_type.tick()
+STATS_HOST = "127.0.0.1"  # only reachable from this machine
+TICK_RATE = 20  # ticks per second
+ACCEPT_PAUSE = 1  # seconds to stop accepting for when out of file descriptors
+
+# Runs `game_tick` at TICK_RATE, and delayed events, e.g.
+# `scheduler.call_later(5, player.respawn)`
+scheduler = TickScheduler(TICK_RATE, game_tick)
+
+def open_listener():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((HOST, PORT))
+    s.listen(128)
+    s.setblocking(False)
+    return s
+
+def open_stats_listener(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((STATS_HOST, port))
+    s.listen(8)
+    s.setblocking(False)
+    return s
+
+def stats_response():
+    """
+    Returns the metrics as a plain text HTTP response, for e.g. curl
+    """
+    body = ("\n".join(metrics.report()) + "\n").encode("utf-8")
+    return (b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n"
+            b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n\r\n" + body)
+
+class StatsConnection:
+    """
+    A connection to the stats port, answered by the selector loop
+    without ever waiting on the socket
+    """
+    timeout = 5  # seconds to wait for the request
+
+    def __init__(self, connection, selector):
+        self.connection = connection
+        self.selector = selector
+        self.response = b""
+        self.closed = False
+        connection.setblocking(False)
+        selector.register(connection, selectors.EVENT_READ, self)
+        self.timer = scheduler.call_later(self.timeout, self.close)
+
+    def handle(self, events):
+        try:
+            if events & selectors.EVENT_READ:
+                # The request is ignored, but read so the connection closes cleanly
+                if not self.connection.recv(4096):
+                    self.close()
+                    return
+                self.response = stats_response()
+                self.selector.modify(self.connection, selectors.EVENT_WRITE, self)
+            elif events & selectors.EVENT_WRITE:
+                sent = self.connection.send(self.response)
+                self.response = self.response[sent:]
+                if not self.response:
+                    self.close()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.timer.cancel()
+            self.selector.unregister(self.connection)
+            self.connection.close()
+
+def open_slots():
+    return sum(MAX_PLAYERS - len(m.clients) for m in matches)
+
+def run_selector_server(listener=None, handoff=None, stats=None):
+    """
+    Runs every match on one selector loop.
+    Players connect to `listener`, a listening socket, or are passed in over
+    `handoff`, a Unix socket, by the lobby in supervisor.py.
+    Without either, it listens on PORT.
+    `stats` is an optional listening socket that serves the metrics.
+    """
+    if listener is None and handoff is None:
+        listener = open_listener()
+
+    # Every socket is registered once, the listening sockets with no data and each
+    # client socket with its Client, so one select() call covers all of them.
+    selector = selectors.DefaultSelector()
+    if listener is not None:
+        selector.register(listener, selectors.EVENT_READ)
+    if handoff is not None:
+        selector.register(handoff, selectors.EVENT_READ)
+    if stats is not None:
+        selector.register(stats, selectors.EVENT_READ)
+
+    def report_load():
+        # Lets the lobby know how busy this process is, and whether its matches have space
+        if handoff is not None:
+            handoff.send("{} {}\n".format(sum(len(m.clients) for m in matches),
+                                          open_slots()).encode("ascii"))
+
+    def accept_client(connection, address):
+        connection.setblocking(False)
+        client = Client(connection, address, find_match())
+        selector.register(connection, selectors.EVENT_READ, client)
+        announce_join(client)
+        report_load()
+
+    def accept(sock):
+        try:
+            return sock.accept()
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            logger.error("Couldn't accept a connection: {}", e)
+            if e.errno in (errno.EMFILE, errno.ENFILE):
+                # Out of file descriptors. The connection stays waiting, so stop
+                # watching for it for a moment instead of failing on it again and again
+                selector.unregister(sock)
+                scheduler.call_later(ACCEPT_PAUSE, selector.register, sock, selectors.EVENT_READ)
+            return None
+
+    def accept_handoff():
+        message, fds, flags, address = socket.recv_fds(handoff, 1024, 64)
+        addresses = message.decode("ascii").split("\n")
+        for fd, address in zip(fds, addresses):
+            host, port = address.rsplit(" ", 1)
+            accept_client(socket.socket(fileno=fd), (host, int(port)))
+
+    def remove_client(client):
+        if client.connection in selector.get_map():
+            selector.unregister(client.connection)
+        paused.discard(client)
+        client.connection.close()
+        delete_client(client)
+        report_load()
+
+    def update_events(client):
+        # Only ask to be woken for writes when output is left over, and stop
+        # reading from clients that aren't keeping up
+        events = 0 if client.throttled() else selectors.EVENT_READ
+        if client.outbound:
+            events |= selectors.EVENT_WRITE
+        key = selector.get_map().get(client.connection)
+        if events == (key.events if key is not None else 0):
+            return
+        if not events:  # not every selector can wait for no events
+            selector.unregister(client.connection)
+        elif key is None:
+            selector.register(client.connection, events, client)
+        else:
+            selector.modify(client.connection, events, client)
+        if events & selectors.EVENT_READ:
+            paused.discard(client)
+        else:
+            paused.add(client)
 
-    for c in Client.clients:
-        c.player.update()
-    
-    for c in Client.clients:
-        readable, writable, exceptional = select.select([c.connection], [c.connection], [], 0.1)
-        if readable:
-            try:
-                c.get_command()
-            except ConnectionResetError:
-                delete_client(c)
+    # Only clients that have been sent messages, had something happen on their
+    # socket, or aren't being read from are looked at each time round, so idle
+    # clients cost nothing
+    active = set()
+    paused = set()
+    while True:
+        start = time.perf_counter()
+        if scheduler.run_due():
+            metrics.record("tick", scheduler.last_duration)
+
+        active.update(messaged_clients())
+        active.update(paused)
+        for c in active:
+            if c not in c.game.clients:  # removed since
                 continue
-    
-            
-        if writable:
             try:
+                c.queue_data()
                 c.send_data()
-            except ConnectionResetError:
-                delete_client(c)
+            except OSError:  # including timeouts and unreachable hosts, not just resets
+                remove_client(c)
+                continue
+            update_events(c)
+        active.clear()
+
+        busy = time.perf_counter() - start
+        ready = selector.select(scheduler.time_until_tick())
+        start = time.perf_counter()
+        for key, events in ready:
+            if key.fileobj is listener:
+                accepted = accept(listener)
+                if accepted is not None:
+                    accept_client(*accepted)
+                continue
+            elif key.fileobj is handoff:
+                accept_handoff()
+                continue
+            elif key.fileobj is stats:
+                accepted = accept(stats)
+                if accepted is not None:
+                    StatsConnection(accepted[0], selector)
+                continue
+            elif isinstance(key.data, StatsConnection):
+                key.data.handle(events)
                 continue
-            
+
+            c = key.data
+            if c not in c.game.clients:  # removed earlier in this batch
+                continue
+            try:
+                if events & selectors.EVENT_READ:
+                    c.get_command()
+                if events & selectors.EVENT_WRITE:
+                    c.send_data()
+            except (OSError, ValueError):
+                remove_client(c)
+            else:
+                active.add(c)
+        # Time spent working, not waiting in select()
+        metrics.record("loop", busy + time.perf_counter() - start)
+
+def report_ticks(interval):
+    logger.info(scheduler.report())
+    scheduler.call_later(interval, report_ticks, interval)
+
+async def handle_connection(reader, writer):
+    client = AsyncClient(reader, writer, find_match())
+    writer.transport.set_write_buffer_limits(high=Client.throttle_mark)
+    announce_join(client)
+    for c in messaged_clients():
+        c.wake_writer()
+    tasks = [asyncio.ensure_future(client.read_commands()),
+             asyncio.ensure_future(client.write_data())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        pass  # the server is stopping
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+        delete_client(client)
+
+async def tick_forever():
+    """
+    Runs the game at a fixed rate, separately from the connections
+    """
+    while True:
+        await asyncio.sleep(scheduler.time_until_tick())
+        if scheduler.run_due():
+            metrics.record("tick", scheduler.last_duration)
+            for c in messaged_clients():
+                c.wake_writer()
+
+async def handle_stats(reader, writer):
+    try:
+        await asyncio.wait_for(reader.read(4096), 1)  # the request, which is ignored
+        writer.write(stats_response())
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+async def run_asyncio_server(stats_port=None):
+    server = await asyncio.start_server(handle_connection, HOST or None, PORT,
+                                        reuse_address=True)
+    if stats_port:
+        await asyncio.start_server(handle_stats, STATS_HOST, stats_port, reuse_address=True)
+    stop = asyncio.Event()
+    try:
+        # Exit normally on SIGTERM, so the journal and log are written out
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    except NotImplementedError:  # not on Windows
+        pass
+    ticker = asyncio.ensure_future(tick_forever())
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        ticker.cancel()
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Run a Quork server.")
+    arg_parser.add_argument("--asyncio", action="store_true",
+                            help="use the asyncio front end")
+    arg_parser.add_argument("--tick-rate", type=float, default=TICK_RATE,
+                            help="game ticks per second (default: %(default)s)")
+    arg_parser.add_argument("--report-interval", type=float, metavar="SECONDS",
+                            help="print a summary of tick times this often")
+    arg_parser.add_argument("--map", action="append", dest="maps", metavar="MAP",
+                            help="a map file, or e.g. maze:100x100 for a generated map; "
+                                 "give more than one to take turns (default: Beige)")
+    arg_parser.add_argument("--grues", type=int, default=GRUES,
+                            help="computer controlled enemies in each match (default: %(default)s)")
+    arg_parser.add_argument("--simultaneous", action="store_true",
+                            help="queue moves, aims and shots and resolve them together each tick")
+    arg_parser.add_argument("--command-rate", type=float, default=Client.command_rate,
+                            help="commands per second each client can send (default: %(default)s)")
+    arg_parser.add_argument("--command-burst", type=int, default=Client.command_burst,
+                            help="commands a client can send at once (default: %(default)s)")
+    arg_parser.add_argument("--log-level", choices=levels, default="info",
+                            help="debug includes every message sent to players (default: %(default)s)")
+    arg_parser.add_argument("--journal", metavar="FILE",
+                            help="record every match in FILE, for quork_replay.py")
+    arg_parser.add_argument("--stats-port", type=int, metavar="PORT",
+                            help="serve metrics over HTTP on this port, to this machine only")
+    args = arg_parser.parse_args()
+    logger.level = levels[args.log_level]
+    logger.start()
+    GRUES = args.grues
+    SIMULTANEOUS = args.simultaneous
+    if args.journal:
+        journal = Journal(args.journal)
+    Client.command_rate = args.command_rate
+    Client.command_burst = args.command_burst
+    if args.maps:
+        match_rotation = [(quork_maps.find_map(spec), Deathmatch25) for spec in args.maps]
+    scheduler.set_rate(args.tick_rate)
+    if args.report_interval:
+        scheduler.call_later(args.report_interval, report_ticks, args.report_interval)
+
+    logger.info("Serving on {} port {}", socket.gethostbyname(socket.gethostname()), PORT)
+    if args.asyncio:
+        asyncio.run(run_asyncio_server(args.stats_port))
+    else:
+        # Exit normally on SIGTERM, so the journal and log are written out
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        run_selector_server(stats=open_stats_listener(args.stats_port) if args.stats_port else None)
@@ -0,0 +1,191 @@
+"""
+Runs matches on several worker processes, so a server can use every core.
+
+The lobby in the main process accepts every connection on PORT, and passes
+the socket to a worker over a Unix socket. Each worker runs
+`server.run_selector_server` with its own matches, and tells the lobby how
+many players it has and how much space is left in its matches, so players
+fill existing matches first and new matches start on the least loaded worker.
+
+Passing sockets between processes needs a Unix-like operating system.
+"""
+import os, sys, time, errno, signal, socket, selectors, argparse, threading
+import multiprocessing, multiprocessing.connection
+
+import server, quork_maps
+from quork_log import logger, levels
+from quork_metrics import metrics
+
+def exit_with_lobby():
+    multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    os._exit(0)
+
+def run_worker(channel, tick_rate, stats_port, inherited):
+    for fd in inherited:  # the lobby's sockets, which forking copied
+        os.close(fd)
+    threading.Thread(target=exit_with_lobby, daemon=True).start()
+    logger.start()  # the lobby's writer thread wasn't copied
+    metrics.reset()  # or the worker would report the lobby's uptime
+    server.scheduler.set_rate(tick_rate)
+    stats = server.open_stats_listener(stats_port) if stats_port else None
+    server.run_selector_server(handoff=channel, stats=stats)
+
+class Worker:
+    def __init__(self, number, tick_rate, inherited, stats_port=None):
+        self.number = number
+        self.tick_rate = tick_rate
+        # Each worker has its own metrics, served on the port after the last worker's
+        stats_port = stats_port + number if stats_port else None
+        self.channel, child_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        context = multiprocessing.get_context("fork")
+        self.process = context.Process(target=run_worker,
+                                       args=(child_channel, tick_rate, stats_port,
+                                             inherited + [self.channel.fileno()]),
+                                       name="quork-worker-{}".format(number),
+                                       daemon=True)
+        self.process.start()
+        child_channel.close()
+        self.players = 0
+        self.open_slots = 0
+
+    def hand_off(self, connection, address):
+        socket.send_fds(self.channel, ["{} {}".format(*address[:2]).encode("ascii")],
+                        [connection.fileno()])
+        # Guess the worker's load until it reports it
+        if self.open_slots:
+            self.open_slots -= 1
+        else:
+            self.open_slots = server.MAX_PLAYERS - 1
+        self.players += 1
+
+    def read_report(self):
+        players, open_slots = self.channel.recv(64).split()
+        self.players = int(players)
+        self.open_slots = int(open_slots)
+
+    def close(self):
+        self.channel.close()
+        self.process.terminate()  # in case it was given up on while still running
+        self.process.join(1)
+
+    def __repr__(self):
+        return "Worker({}, players={}, open_slots={})".format(self.number,
+                                                              self.players,
+                                                              self.open_slots)
+
+def choose_worker(workers):
+    """
+    Picks the least loaded worker with space in one of its matches,
+    or the least loaded worker if none of them have space.
+    """
+    with_space = [w for w in workers if w.open_slots > 0]
+    return min(with_space or workers, key=lambda w: w.players)
+
+def run_lobby(worker_count, tick_rate, stats_port=None):
+    workers = []
+    for number in range(worker_count):
+        workers.append(Worker(number, tick_rate,
+                              [w.channel.fileno() for w in workers], stats_port))
+    listener = server.open_listener()
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    for w in workers:
+        selector.register(w.channel, selectors.EVENT_READ, w)
+        selector.register(w.process.sentinel, selectors.EVENT_READ, w)
+
+    def restart(dead):
+        # Starts another worker in place of one that has died
+        selector.unregister(dead.channel)
+        selector.unregister(dead.process.sentinel)
+        dead.close()
+        logger.warning("Worker {} exited with code {}, restarting it",
+                       dead.number, dead.process.exitcode)
+        workers.remove(dead)
+        replacement = Worker(dead.number, tick_rate,
+                             [listener.fileno()] + [w.channel.fileno() for w in workers],
+                             stats_port)
+        workers.append(replacement)
+        selector.register(replacement.channel, selectors.EVENT_READ, replacement)
+        selector.register(replacement.process.sentinel, selectors.EVENT_READ, replacement)
+
+    def hand_off(connection, address):
+        # A worker can die just before it is picked, before the lobby hears
+        # it has, so try the others in turn, restarting each one that fails
+        for attempt in range(len(workers)):
+            worker = choose_worker(workers)
+            try:
+                worker.hand_off(connection, address)
+                return
+            except OSError as e:
+                logger.warning("Couldn't pass {} to worker {}: {}", address[0], worker.number, e)
+                restart(worker)
+        logger.error("No worker would take {}, disconnecting them", address[0])
+
+    resume_accepting = None  # when to watch the listener again, after running out of file descriptors
+    while True:
+        timeout = None
+        if resume_accepting is not None:
+            timeout = max(0, resume_accepting - time.monotonic())
+            if not timeout:
+                selector.register(listener, selectors.EVENT_READ)
+                resume_accepting = timeout = None
+        for key, events in selector.select(timeout):
+            if key.data is not None and key.data not in workers:
+                continue  # restarted earlier in this batch
+            if key.fileobj is listener:
+                try:
+                    connection, address = listener.accept()
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    logger.error("Couldn't accept a connection: {}", e)
+                    if e.errno in (errno.EMFILE, errno.ENFILE):
+                        # The connection stays waiting, so stop watching for it for a moment
+                        selector.unregister(listener)
+                        resume_accepting = time.monotonic() + server.ACCEPT_PAUSE
+                    continue
+                with connection:
+                    hand_off(connection, address)
+            elif key.fileobj is key.data.channel:
+                key.data.read_report()
+            else:
+                restart(key.data)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Run a Quork server on several processes.")
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="number of worker processes (default: one per core)")
+    arg_parser.add_argument("--tick-rate", type=float, default=server.TICK_RATE,
+                            help="game ticks per second (default: %(default)s)")
+    arg_parser.add_argument("--map", action="append", dest="maps", metavar="MAP",
+                            help="a map file, or e.g. maze:100x100 for a generated map; "
+                                 "give more than one to take turns (default: Beige)")
+    arg_parser.add_argument("--grues", type=int, default=server.GRUES,
+                            help="computer controlled enemies in each match (default: %(default)s)")
+    arg_parser.add_argument("--simultaneous", action="store_true",
+                            help="queue moves, aims and shots and resolve them together each tick")
+    arg_parser.add_argument("--command-rate", type=float, default=server.Client.command_rate,
+                            help="commands per second each client can send (default: %(default)s)")
+    arg_parser.add_argument("--command-burst", type=int, default=server.Client.command_burst,
+                            help="commands a client can send at once (default: %(default)s)")
+    arg_parser.add_argument("--stats-port", type=int, metavar="PORT",
+                            help="serve each worker's metrics over HTTP, to this machine only, "
+                                 "worker n on PORT + n")
+    arg_parser.add_argument("--log-level", choices=levels, default="info",
+                            help="debug includes every message sent to players (default: %(default)s)")
+    args = arg_parser.parse_args()
+    logger.level = levels[args.log_level]
+    logger.start()
+    server.GRUES = args.grues  # set before forking, so every worker uses them
+    server.SIMULTANEOUS = args.simultaneous
+    server.Client.command_rate = args.command_rate
+    server.Client.command_burst = args.command_burst
+    if args.maps:  # loaded here, so the workers get them when they are forked
+        server.match_rotation = [(quork_maps.find_map(spec), server.Deathmatch25) for spec in args.maps]
+
+    # Exit normally on SIGTERM, so multiprocessing stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Serving on {} port {} with {} workers",
+                socket.gethostbyname(socket.gethostname()), server.PORT, args.workers)
+    run_lobby(args.workers, args.tick_rate, args.stats_port)
@@ -0,0 +1,176 @@
+import time
+
+from quork_log import logger
+
+class Timer:
+    def __init__(self, expiry, callback, args):
+        self.expiry = expiry
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __repr__(self):
+        return "Timer({}, {})".format(self.expiry, repr(self.callback))
+
+class TimerWheel:
+    """
+    A hierarchical timing wheel, counting in ticks.
+    Level 0 has a slot for each of the next `slots` ticks, level 1 a slot for
+    each of the next `slots` blocks of `slots` ticks, and so on.
+    Timers move down a level each time their block comes round, so scheduling,
+    cancelling and advancing are all O(1) however many timers there are.
+    """
+    def __init__(self, slots=64, levels=4):
+        self.slots = slots
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.now = 0
+        self.limit = slots ** levels
+
+    def schedule(self, delay, callback, *args):
+        """
+        Calls `callback(*args)` in `delay` ticks (at least 1).
+        Returns a Timer that can be cancelled.
+        """
+        delay = max(1, int(delay))
+        if delay >= self.limit:
+            raise ValueError("Timer delay of {} ticks is too long".format(delay))
+        timer = Timer(self.now + delay, callback, args)
+        self._insert(timer)
+        return timer
+
+    def _insert(self, timer):
+        delay = timer.expiry - self.now
+        level = 0
+        span = self.slots
+        while delay >= span:
+            level += 1
+            span *= self.slots
+        index = (timer.expiry // (span // self.slots)) % self.slots
+        self.wheels[level][index].append(timer)
+
+    def advance(self):
+        """
+        Moves on one tick, and runs the timers that are due
+        """
+        self.now += 1
+        # Cascade the blocks that start at this tick down a level
+        block = self.slots
+        for wheel in self.wheels[1:]:
+            if self.now % block:
+                break
+            index = (self.now // block) % self.slots
+            timers, wheel[index] = wheel[index], []
+            for timer in timers:
+                if not timer.cancelled:
+                    self._insert(timer)
+            block *= self.slots
+
+        index = self.now % self.slots
+        timers, self.wheels[0][index] = self.wheels[0][index], []
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+class TokenBucket:
+    """
+    Allows up to `burst` things at once, and `rate` more each time it is refilled
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+
+    def refill(self):
+        self.tokens = min(self.burst, self.tokens + self.rate)
+
+    def take(self):
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class TickScheduler:
+    """
+    Runs `tick` at a fixed rate, and delayed events on a TimerWheel.
+    The caller waits for `time_until_tick()` (e.g. as a select() timeout),
+    then calls `run_due()`.
+    """
+    def __init__(self, rate, tick, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.timers = TimerWheel()
+        self.set_rate(rate)
+        self.next_tick = clock()
+
+        self.ticks = 0
+        self.overruns = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.window = (0, 0.0, 0)  # ticks, total_duration and overruns at the last report
+        self.window_max = 0.0
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.interval = 1 / rate
+
+    def call_later(self, seconds, callback, *args):
+        """
+        Calls `callback(*args)` after the tick `seconds` from now.
+        """
+        return self.timers.schedule(round(seconds * self.rate), callback, *args)
+
+    def time_until_tick(self):
+        return max(0.0, self.next_tick - self.clock())
+
+    def run_due(self):
+        """
+        Runs a tick if one is due. Returns whether it did.
+        """
+        start = self.clock()
+        if start < self.next_tick:
+            return False
+        self.tick()
+        self.timers.advance()
+        end = self.clock()
+
+        self.ticks += 1
+        self.last_duration = end - start
+        self.max_duration = max(self.max_duration, self.last_duration)
+        self.total_duration += self.last_duration
+        self.window_max = max(self.window_max, self.last_duration)
+        if self.last_duration > self.interval:
+            self.overruns += 1
+            self.report_overrun(self.last_duration)
+        self.next_tick += self.interval
+        if end > self.next_tick:
+            # Don't try to catch up on missed ticks, that would only make it worse
+            self.next_tick = end
+        return True
+
+    def report_overrun(self, duration):
+        logger.warning("Tick {} took {:.1f} ms, longer than the {:.1f} ms tick interval",
+                       self.ticks, duration * 1000, self.interval * 1000)
+
+    def report(self):
+        """
+        Summarises the ticks since the last report, on one line
+        """
+        ticks, total_duration, overruns = self.window
+        ticks = self.ticks - ticks
+        mean = (self.total_duration - total_duration) / ticks if ticks else 0.0
+        line = "tick-report ticks={} mean_ms={:.3f} max_ms={:.3f} overruns={}".format(ticks,
+                                                                                   mean * 1000,
+                                                                                   self.window_max * 1000,
+                                                                                   self.overruns - overruns)
+        self.window = (self.ticks, self.total_duration, self.overruns)
+        self.window_max = 0.0
+        return line
+
+    def run_forever(self, sleep=time.sleep):
+        while True:
+            sleep(self.time_until_tick())
+            self.run_due()
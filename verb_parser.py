@@ -18,42 +18,48 @@ class Remainder:
     def __repr__(self):
         return "Remainder({})".format(repr(self.name))
 
+def match_pattern(pattern, words):
+    """
+    Matches a list of words against a pattern of words, Variables and Remainders.
+    Returns a dict of the variables, or None if they don't match.
+    """
+    variables = {}
+    for index, (a, b) in enumerate(zip(pattern, words)):
+        if isinstance(a, str):
+            if a != b:
+                return None
+        elif isinstance(a, Variable):
+            variables[a.name] = b
+        else:  # a Remainder
+            variables[a.name] = " ".join(words[index:])
+            break
+    return variables
+
 class Verb:
     def __init__(self, *words, desc=""):
         self.words = words
         self.aliases = []
         self.desc = desc#ription
+        self.handler = None  # the name of the method that carries out the verb
 
     def alias(self, *words):
         self.aliases.append(Verb(*words))
 
+    def patterns(self):
+        yield self.words
+        for alias in self.aliases:
+            yield alias.words
+
     def match(self, words):
-        try:
-            variables = {}
-            if len(self.words) != len(words) and not any(isinstance(p, Remainder) for p in self.words):
-                raise Parser.ParseError("Command '{}' has a different amount of words to the pattern that matches it".format(words))
-            
-            for index, (a, b) in enumerate(zip(self.words, words)):
-                if isinstance(a, Variable):
-                    variables[a.name] = b
-                elif isinstance(a, str):
-                    if a != b:
-                        raise Parser.ParseError("'{}' does not match '{}'".format(a, b))
-                elif isinstance(a, Remainder):
-                    variables[a.name] = " ".join(words[index:])
-                    break
-                else:
-                    raise Parser.ParseError("Invalid verb part {}".format(repr(a)))
-                
-            return (self, variables)
-        except Parser.ParseError:
-            for alias in self.aliases:
-                try:
-                    return (self, alias.match(words)[-1])
-                except Parser.ParseError:
-                    raise
-            else:
-                raise Parser.ParseError("Unmatched verb")
+        """
+        Returns `(self, variables)` if the words match the verb or one of its aliases, otherwise None
+        """
+        for pattern in self.patterns():
+            if Parser.pattern_fits(pattern, len(words)):
+                variables = match_pattern(pattern, words)
+                if variables is not None:
+                    return (self, variables)
+        return None
 
     def __str__(self):
         return " ".join(map(str, self.words)) + " - " + self.desc
@@ -62,24 +68,57 @@ class Verb:
         return "Verb({})".format(", ".join(map(repr, self.words)))
 
 class Parser:
+    """
+    Matches commands against a list of verbs.
+    Patterns are indexed by their first word and length, so a command is only
+    compared with the few patterns that could match it.
+    Patterns ending in a Remainder are tried after the fixed length ones.
+    """
     class ParseError(Exception):
         pass
-    
+
     def __init__(self, verbs):
         self.verbs = verbs
+        self.fixed = {}       # (first word, word count) -> [(verb, pattern)]
+        self.remainders = {}  # first word -> [(verb, pattern)]
+        for verb in verbs:
+            for pattern in verb.patterns():
+                if not pattern:
+                    raise Parser.ParseError("Verb {} has an empty pattern".format(repr(verb)))
+                for part in pattern:
+                    if not isinstance(part, (str, Variable, Remainder)):
+                        raise Parser.ParseError("Invalid verb part {}".format(repr(part)))
+                    if isinstance(part, Remainder) and part is not pattern[-1]:
+                        raise Parser.ParseError("Remainder {} isn't at the end of {}".format(repr(part), repr(verb)))
+                # Patterns starting with a Variable are filed under None
+                first = pattern[0] if isinstance(pattern[0], str) else None
+                if isinstance(pattern[-1], Remainder):
+                    self.remainders.setdefault(first, []).append((verb, pattern))
+                else:
+                    self.fixed.setdefault((first, len(pattern)), []).append((verb, pattern))
+
+    @staticmethod
+    def pattern_fits(pattern, length):
+        if isinstance(pattern[-1], Remainder):
+            return length >= len(pattern)
+        return length == len(pattern)
 
     def parse(self, command):
+        """
+        Returns `(verb, variables)` for the verb matching the command, or None
+        """
         words = command.split()
         if not words:
             return None
-        for v in self.verbs:
-            try:
-                variables = v.match(words)
-                return variables
-            except Parser.ParseError:
-                continue
-        else:
-            return None
-
-
-        
+        for key in ((words[0], len(words)), (None, len(words))):
+            for verb, pattern in self.fixed.get(key, ()):
+                variables = match_pattern(pattern, words)
+                if variables is not None:
+                    return (verb, variables)
+        for key in (words[0], None):
+            for verb, pattern in self.remainders.get(key, ()):
+                if self.pattern_fits(pattern, len(words)):
+                    variables = match_pattern(pattern, words)
+                    if variables is not None:
+                        return (verb, variables)
+        return None